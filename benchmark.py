@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""Benchmark each stage of the story_feature_policy_report.py pipeline.
+
+Uses fixed synthetic data from fake_jira.py so that results can be
+compared between revisions. For each stage the wall and CPU times (best
+of --repeat runs) and the peak memory allocated (from a separate run with
+tracemalloc) are reported as JSON, for example:
+
+  ./benchmark.py --issues 10000 > before.json
+  ...change code...
+  ./benchmark.py --issues 10000 --compare before.json > after.json
+
+With --compare the change for each stage is printed to stderr and the
+exit status is 1 if any stage is slower by more than --threshold.
+
+With --verify the fast paths are first checked against the code they
+replace, html2text.wrap_para() against textwrap.wrap() for random
+paragraphs and those of the optwrap input, and the exit status is 1 if
+any differ.
+
+Python3 only.
+"""
+
+import contextlib
+import copy
+import io
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import textwrap
+import time
+import tracemalloc
+from datetime import datetime
+from optparse import OptionParser
+
+import fake_jira
+import html2text
+import story_feature_policy_report as report
+
+FIELDS = report.report_fields([report.FEATURE_TEMPLATE, report.POLICY_TEMPLATE,
+                               report.USER_STORY_TEMPLATE])
+# Size of the text for the optwrap stage, as for long descriptions pasted from Word
+WRAP_SIZE = 4 * 1024 * 1024
+# Pieces of random paragraphs for --verify, mixing words, runs of spaces and
+# the hyphens that textwrap breaks words at
+WRAP_ALPHABETS = ['a-1 ', 'a-b ', '--a', 'ab-1-2-3--', '9-', 'ab ', 'a ', 'abc  ', 'a    ',
+                  'aaaaaaab ', 'x.Y*_[] ', '9-a ', 'aaaa-1 ', '1---- ', 'Z-9-9-9  ', '-1-a']
+WRAPPER_TEMPLATE = open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     'templates', 'irs_wrapper.tpl')).read()
+
+
+def make_xml(num, seed):
+    """XML view response for num synthetic issues, as bytes."""
+    issues = fake_jira.generate_issues(num, seed)
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>\n<rss version="0.92">\n<channel>\n'
+           '<issue start="0" end="%d" total="%d"/>\n' % (num, num)]
+    for issue in issues:
+        xml.append(fake_jira.issue_to_xml(issue, 'http://localhost/', frozenset(FIELDS)))
+    xml.append('</channel>\n</rss>\n')
+    return ''.join(xml).encode('utf-8')
+
+
+def parse(xml):
+    return list(report.iter_jira_items(io.BytesIO(xml), clear=False))
+
+
+def split(items):
+    return report.split_jira_results(items, FIELDS)
+
+
+def convert_html(results, workers, chunk_size):
+    (features, policies, user_stories, epics) = results
+    report.convert_issues_html(features + policies + user_stories + epics, workers, chunk_size)
+    return results
+
+
+def html_to_tex(htmls):
+    return [report.convert_html_to_tex(html) for html in htmls]
+
+
+def html_to_tex_cached(args):
+    """Conversion with a TeX cache that is warm from a previous run."""
+    (cache, htmls) = args
+    return [cache.get(html, report.convert_html_to_tex) for html in htmls]
+
+
+def warm_tex_cache(htmls, texs):
+    """(cache, htmls) with cache already holding texs for htmls."""
+    cache = report.TexCache(size=len(htmls))
+    cache.memory.update(zip(htmls, texs))
+    return (cache, htmls)
+
+
+def make_markdown(htmls, size):
+    """Unwrapped html2text output for htmls, repeated to at least size characters."""
+    h = html2text.HTML2Text()
+    h.body_width = 0
+    text = h.handle(''.join('<p>%s</p>' % html for html in htmls))
+    return text * (size // len(text) + 1)
+
+
+def optwrap(text):
+    return html2text.HTML2Text().optwrap(text)
+
+
+def add_links(results):
+    (features, policies, user_stories, epics) = results
+    registry = report.IssueRegistry(features, policies, user_stories, epics)
+    report.add_epic_names(user_stories, epics)
+    report.add_story_epics(features, registry)
+    report.add_story_epics(policies, registry)
+    report.add_related(features)
+    report.add_related(policies)
+    report.add_related(user_stories)
+    return results
+
+
+def priorities(results):
+    (features, policies, user_stories, epics) = results
+    registry = report.IssueRegistry(features, policies, user_stories, epics)
+    graph = report.priority_graph(registry)
+    (inferred, effective) = graph.infer_max(('Feature', 'Policy'))
+    report.infer_feature_policy_priorities(inferred, features)
+    report.infer_feature_policy_priorities(inferred, policies)
+    report.check_story_priorities(graph, user_stories)
+    return results
+
+
+def render(results):
+    (features, policies, user_stories, epics) = results
+    wrapper_args = {'name': 'benchmark', 'now': '', 'date': '', 'query': '', 'program': ''}
+    return report.render_report(WRAPPER_TEMPLATE, wrapper_args, features, policies, user_stories)
+
+
+def measure(func, make_input, repeat):
+    """Time func(make_input()) repeat times, then once more for peak memory.
+
+    The input is made afresh for each run, outside the timing, because
+    the stages modify their input. Output from the stage is discarded.
+    """
+    walls = []
+    cpus = []
+    for n in range(repeat):
+        arg = make_input()
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            c0 = time.process_time()
+            func(arg)
+            cpus.append(time.process_time() - c0)
+            walls.append(time.perf_counter() - t0)
+    arg = make_input()
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(arg)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'wall': min(walls),
+            'wall_mean': sum(walls) / len(walls),
+            'cpu': min(cpus),
+            'peak_kb': peak // 1024}
+
+
+def run_benchmarks(num, seed, repeat, stages=None, workers=1, chunk_size=64):
+    """Run all stages (or just those named in stages), return results dict.
+
+    workers and chunk_size are for the convert_html stage.
+    """
+    xml = make_xml(num, seed)
+    items = parse(xml)
+    htmls = []
+    for item in items:
+        for tag in ('summary', 'description'):
+            el = item.find(tag)
+            if (el is not None and el.text):
+                htmls.append(el.text)
+    with contextlib.redirect_stdout(io.StringIO()):
+        split_results = split(copy.deepcopy(items))
+        converted_results = convert_html(copy.deepcopy(split_results), 1, chunk_size)
+        linked_results = add_links(copy.deepcopy(converted_results))
+        prioritized_results = priorities(copy.deepcopy(linked_results))
+        texs = html_to_tex(htmls)
+        markdown = make_markdown(htmls, WRAP_SIZE)
+    plan = [
+        ('parse', parse, lambda: xml),
+        ('split_jira_results', split, lambda: copy.deepcopy(items)),
+        ('convert_html', lambda results: convert_html(results, workers, chunk_size),
+         lambda: copy.deepcopy(split_results)),
+        ('html_to_tex', html_to_tex, lambda: htmls),
+        ('html_to_tex_cached', html_to_tex_cached, lambda: warm_tex_cache(htmls, texs)),
+        ('optwrap', optwrap, lambda: markdown),
+        ('add_links', add_links, lambda: copy.deepcopy(converted_results)),
+        ('priorities', priorities, lambda: copy.deepcopy(linked_results)),
+        ('render', render, lambda: copy.deepcopy(prioritized_results)),
+    ]
+    results = {}
+    for (name, func, make_input) in plan:
+        if (stages and name not in stages):
+            continue
+        results[name] = measure(func, make_input, repeat)
+        sys.stderr.write("%-20s %8.3fs\n" % (name, results[name]['wall']))
+    return {'xml_bytes': len(xml), 'html_fields': len(htmls), 'wrap_bytes': len(markdown),
+            'stages': results}
+
+
+def verify_wrap_para(paras, trials, seed):
+    """List of (para, width) for which wrap_para() differs from textwrap.wrap().
+
+    Each of paras is checked at a few widths, then trials random paragraphs
+    of pieces from WRAP_ALPHABETS at random widths.
+    """
+    rng = random.Random(seed)
+    cases = [(para, width) for para in paras for width in (1, 7, 30, 78)]
+    for trial in range(trials):
+        alphabet = rng.choice(WRAP_ALPHABETS)
+        para = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 40)))
+        cases.append((para, rng.randint(1, 12)))
+    return [(para, width) for (para, width) in cases
+            if html2text.wrap_para(para, width) != textwrap.wrap(para, width)]
+
+
+def verify(num, seed, trials=100000):
+    """Check fast paths against the code they replace, return True if all agree."""
+    xml = make_xml(num, seed)
+    htmls = []
+    for item in parse(xml):
+        el = item.find('description')
+        if (el is not None and el.text):
+            htmls.append(el.text)
+    paras = set(make_markdown(htmls, 0).split('\n'))
+    failures = verify_wrap_para(sorted(paras), trials, seed)
+    for (para, width) in failures[:10]:
+        sys.stderr.write("wrap_para(%r, %d) differs from textwrap.wrap()\n" % (para, width))
+    sys.stderr.write("%-20s %d paragraphs + %d random, %d differ\n" %
+                     ('verify wrap_para', len(paras), trials, len(failures)))
+    return not failures
+
+
+def git_revision():
+    """Current git revision of the code being benchmarked, else None."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    """Print comparison of new with old results, return True if any stage regressed."""
+    regressed = False
+    for (name, result) in new['stages'].items():
+        if (name not in old['stages']):
+            continue
+        before = old['stages'][name]['wall']
+        ratio = result['wall'] / before if before > 0 else 1.0
+        flag = ''
+        if (ratio > 1.0 + threshold):
+            flag = ' REGRESSION'
+            regressed = True
+        sys.stderr.write("%-20s %8.3fs -> %8.3fs (x%.2f)%s\n" % (name, before, result['wall'], ratio, flag))
+    return regressed
+
+
+def main():
+    parser = OptionParser(description="Benchmark stages of the report pipeline, write JSON results to stdout")
+    parser.add_option("-n", "--issues", type="int", default=2000,
+                      help="number of synthetic issues (default %default)")
+    parser.add_option("--seed", type="int", default=1,
+                      help="random seed for synthetic issues (default %default)")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="number of timed runs of each stage (default %default)")
+    parser.add_option("--stage", action="append", dest="stages",
+                      help="run only this stage, may be repeated")
+    parser.add_option("--workers", type="int", default=1,
+                      help="processes for the convert_html stage (default %default)")
+    parser.add_option("--chunk-size", dest="chunk_size", type="int", default=64,
+                      help="HTML strings per task for the convert_html stage (default %default)")
+    parser.add_option("--compare", metavar="FILE",
+                      help="compare with earlier JSON results in FILE")
+    parser.add_option("--threshold", type="float", default=0.1,
+                      help="fractional slow down reported as a regression (default %default)")
+    parser.add_option("--verify", action="store_true",
+                      help="first check html2text.wrap_para() gives the same lines as "
+                           "textwrap.wrap(), exit status 1 if not")
+    (options, args) = parser.parse_args()
+    logging.disable(logging.WARNING)  # warnings about the synthetic data
+    report.TEX_CACHE.size = 0  # time conversion in every repeat of each stage
+    if (options.verify and not verify(options.issues, options.seed)):
+        sys.exit(1)
+
+    results = {'revision': git_revision(),
+               'date': datetime.now().isoformat(),
+               'python': platform.python_version(),
+               'issues': options.issues,
+               'seed': options.seed,
+               'repeat': options.repeat,
+               'workers': options.workers}
+    results.update(run_benchmarks(options.issues, options.seed, options.repeat, options.stages,
+                                  options.workers, options.chunk_size))
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if (options.compare):
+        with open(options.compare) as fh:
+            old = json.load(fh)
+        if (old.get('issues') != options.issues or old.get('seed') != options.seed):
+            sys.stderr.write("Warning: comparing results for different inputs\n")
+        if (compare(old, results, options.threshold)):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
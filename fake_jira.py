@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+"""Stand-in Jira server with synthetic data for testing and benchmarking.
+
+Serves just enough of the Jira API for story_feature_policy_report.py:
+
+  POST rest/auth/1/session - cookie login
+  GET sr/jira.issueviews:searchrequest-xml/temp/SearchRequest.xml - XML issue view
+  GET rest/api/2/search - JSON REST API search
+
+backed by a generated set of Epics, Features, Policies and User Stories
+with issue links, epic links and time estimates like those in the IRS
+project. The JQL is mostly ignored, only `key in (...)`,
+`issuetype in (...)`, `component = "..."` and `updated >= "..."` clauses
+are understood, so every other query returns all issues.
+
+For example, to time a report run with 10k issues:
+
+  ./fake_jira.py --issues 10000 --port 8080 &
+  ./fake_jira.py --config 8080 > irs_reporter.cfg
+  time ./story_feature_policy_report.py --no-cache
+
+Python3 only.
+"""
+
+import json
+import logging
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape
+
+PROJECT = 'IRS'
+PRIORITIES = ['Critical', 'Major', 'Low']
+STATUSES = ['Open', 'In Progress', 'Resolved', 'Closed']
+COMPONENTS = ['Access & Delivery', 'Deposit', 'Preservation', 'Discovery', 'Reporting']
+WORDS = ('repository item collection deposit metadata embargo license report user '
+         'faculty student author search harvest statistics version file format '
+         'workflow review approve export import identifier persistent access '
+         'restricted public thesis dataset community notify batch').split()
+EPIC_LINK_FIELD = 'customfield_10730'
+SESSION_TOKEN = 'cloud.session.token'
+SESSION_LIFETIME = 3600
+BASE_TIME = datetime(2017, 9, 1, 9, 0)
+
+
+def sentence(rng, n):
+    """Random sentence of n words."""
+    words = [rng.choice(WORDS) for i in range(n)]
+    return ' '.join(words).capitalize()
+
+
+def html_description(rng, keys):
+    """Random HTML description with emphasis, lists and links to issues in keys."""
+    paras = []
+    for i in range(rng.randint(1, 4)):
+        text = sentence(rng, rng.randint(8, 40))
+        if (rng.random() < 0.3):
+            text += ' <b>%s</b>' % (sentence(rng, 2))
+        if (rng.random() < 0.3):
+            text += ' <em>%s</em>' % (sentence(rng, 3))
+        if (keys and rng.random() < 0.4):
+            key = rng.choice(keys)
+            text += ' See <a href="https://jira.example.org/browse/%s">%s</a>.' % (key, key)
+        paras.append('<p>%s.</p>' % (text))
+    if (rng.random() < 0.2):
+        paras.append('<ul>' + ''.join('<li>%s</li>' % sentence(rng, 5) for i in range(3)) + '</ul>')
+    return '\n'.join(paras)
+
+
+def format_timeestimate(seconds):
+    """Format seconds as in the XML view, e.g. '1 week, 2 days, 4 hours'."""
+    parts = []
+    for (unit, length) in (('week', 5 * 8 * 3600), ('day', 8 * 3600), ('hour', 3600), ('minute', 60)):
+        n = seconds // length
+        seconds -= n * length
+        if (n > 0):
+            parts.append('%d %s%s' % (n, unit, '' if n == 1 else 's'))
+    return ', '.join(parts) if parts else '0 minutes'
+
+
+def add_link(issues, from_key, to_key, linktype):
+    """Add link from_key -> to_key of linktype ('Rely' or 'Relation') to both issues."""
+    issues[from_key]['links'].append((linktype, 'outward', to_key))
+    issues[to_key]['links'].append((linktype, 'inward', from_key))
+
+
+def generate_issues(num, seed=1):
+    """Generate num synthetic issues, returns list in key order.
+
+    About 2% are Epics, 30% Features, 10% Policies and the rest User
+    Stories. Each User Story belongs to an Epic and relies on a few Features
+    and Policies, some Features rely on Policies, and there are a few
+    'relates to' links. Most Features have a time estimate. All are
+    deterministic for a given seed.
+    """
+    rng = random.Random(seed)
+    num_epics = max(1, num // 50)
+    num_features = max(1, num * 30 // 100)
+    num_policies = max(1, num // 10)
+    num_stories = max(1, num - num_epics - num_features - num_policies)
+    types = (['Epic'] * num_epics + ['New Feature'] * num_features +
+             ['Policy Question'] * num_policies + ['User Story'] * num_stories)
+    rng.shuffle(types)
+    issues = {}
+    keys = []
+    by_type = {}
+    for n, issue_type in enumerate(types, start=1):
+        key = '%s-%d' % (PROJECT, n)
+        keys.append(key)
+        by_type.setdefault(issue_type, []).append(key)
+        issues[key] = {
+            'key': key,
+            'id': str(10000 + n),
+            'type': issue_type,
+            'priority': rng.choice(PRIORITIES),
+            'status': rng.choice(STATUSES),
+            'component': rng.choice(COMPONENTS),
+            'updated': BASE_TIME - timedelta(minutes=rng.randint(0, 60 * 24 * 365)),
+            'links': [],
+        }
+    for key in keys:
+        issue = issues[key]
+        if (issue['type'] == 'Epic'):
+            issue['summary'] = 'Epic %s %s' % (key, sentence(rng, 2))
+            issue['description'] = '<p>%s.</p>' % (sentence(rng, 10))
+        elif (issue['type'] == 'New Feature'):
+            issue['summary'] = 'Feature: ' + sentence(rng, rng.randint(3, 8))
+            issue['description'] = html_description(rng, keys)
+            if (rng.random() < 0.8):
+                issue['timeestimate'] = 3600 * rng.randint(1, 400)
+        elif (issue['type'] == 'Policy Question'):
+            issue['summary'] = 'Policy: ' + sentence(rng, rng.randint(3, 8))
+            issue['description'] = html_description(rng, keys)
+        else:
+            issue['summary'] = 'As a %s I want to %s' % (rng.choice(WORDS), sentence(rng, rng.randint(4, 10)).lower())
+            issue['description'] = html_description(rng, []) if rng.random() < 0.7 else ''
+            issue['epic'] = rng.choice(by_type['Epic'])
+    features = by_type.get('New Feature', [])
+    policies = by_type.get('Policy Question', [])
+    for key in by_type.get('User Story', []):
+        targets = set(rng.sample(features, min(len(features), rng.randint(1, 4))))
+        if (policies and rng.random() < 0.5):
+            targets.add(rng.choice(policies))
+        for target in sorted(targets):
+            add_link(issues, key, target, 'Rely')
+    for key in features:
+        if (policies and rng.random() < 0.2):
+            add_link(issues, key, rng.choice(policies), 'Rely')
+        if (rng.random() < 0.05):
+            add_link(issues, key, rng.choice(features), 'Relation')
+    epic_names = dict((key, issues[key]['summary']) for key in by_type['Epic'])
+    for key in by_type.get('User Story', []):
+        issues[key]['epic_name'] = epic_names[issues[key]['epic']]
+    return [issues[key] for key in keys]
+
+
+LINK_TYPES = {
+    'Rely': ('10062', 'relies on', 'is relied upon by'),
+    'Relation': ('10061', 'relates to', 'relates to'),
+}
+
+
+def issue_to_xml(issue, baseuri, fields):
+    """XML view item for issue, including only the fields requested.
+
+    An empty fields set means all fields. The epic link reproduces the Jira
+    bug noted in parse_epic_link() in story_feature_policy_report.py where
+    the key attribute is '$xmlutils.escape($text)' and the value is the
+    epic name.
+    """
+    key = issue['key']
+    link = baseuri + 'browse/' + key
+
+    def want(field):
+        return (not fields) or (field in fields)
+
+    xml = ['<item>\n<title>[%s] %s</title>\n<link>%s</link>\n' % (key, escape(issue['summary']), link),
+           '<key id="%s">%s</key>\n' % (issue['id'], key)]
+    if (want('summary')):
+        xml.append('<summary>%s</summary>\n' % escape(issue['summary']))
+    if (want('description')):
+        xml.append('<description>%s</description>\n' % escape(issue['description']))
+    if (want('type')):
+        xml.append('<type id="1">%s</type>\n' % (issue['type']))
+    if (want('priority')):
+        xml.append('<priority id="%d">%s</priority>\n' % (PRIORITIES.index(issue['priority']) + 1, issue['priority']))
+    if (want('status')):
+        xml.append('<status id="1">%s</status>\n' % (issue['status']))
+    if (want('component')):
+        xml.append('<component>%s</component>\n' % escape(issue['component']))
+    if (want('updated')):
+        xml.append('<updated>%s</updated>\n' % (issue['updated'].strftime('%a, %d %b %Y %H:%M:%S -0400')))
+    if (want('timetracking') and 'timeestimate' in issue):
+        xml.append('<timeestimate seconds="%d">%s</timeestimate>\n' %
+                   (issue['timeestimate'], format_timeestimate(issue['timeestimate'])))
+    if (want('issuelinks') and issue['links']):
+        xml.append('<issuelinks>\n')
+        for linktype in sorted(LINK_TYPES.keys()):
+            (type_id, outward, inward) = LINK_TYPES[linktype]
+            links = [l for l in issue['links'] if l[0] == linktype]
+            if (not links):
+                continue
+            xml.append('<issuelinktype id="%s">\n<name>%s</name>\n' % (type_id, linktype))
+            for (direction, description) in (('outward', outward), ('inward', inward)):
+                targets = [l[2] for l in links if l[1] == direction]
+                if (targets):
+                    xml.append('<%slinks description="%s">\n' % (direction, description))
+                    for target in targets:
+                        xml.append('<issuelink>\n<issuekey id="%s">%s</issuekey>\n</issuelink>\n' %
+                                   (10000 + int(target.split('-')[1]), target))
+                    xml.append('</%slinks>\n' % (direction))
+            xml.append('</issuelinktype>\n')
+        xml.append('</issuelinks>\n')
+    if ((want('allcustom') or EPIC_LINK_FIELD in fields) and 'epic' in issue):
+        xml.append('<customfields>\n<customfield id="%s" key="com.pyxis.greenhopper.jira:gh-epic-link">\n'
+                   '<customfieldname>Epic Link</customfieldname>\n<customfieldvalues>\n'
+                   '<customfieldvalue key="$xmlutils.escape($text)">%s</customfieldvalue>\n'
+                   '</customfieldvalues>\n</customfield>\n</customfields>\n' %
+                   (EPIC_LINK_FIELD, escape(issue['epic_name'])))
+    xml.append('</item>\n')
+    return ''.join(xml)
+
+
+def issue_to_json(issue, baseuri, fields):
+    """JSON REST API data for issue, including only the fields requested."""
+    def want(field):
+        return (not fields) or ('*all' in fields) or (field in fields)
+
+    data = {'id': issue['id'], 'key': issue['key'],
+            'self': baseuri + 'rest/api/2/issue/' + issue['id']}
+    f = {}
+    rendered = {}
+    if (want('issuetype')):
+        f['issuetype'] = {'name': issue['type']}
+    if (want('summary')):
+        f['summary'] = issue['summary']
+    if (want('description')):
+        f['description'] = issue['description']
+        rendered['description'] = issue['description']
+    if (want('status')):
+        f['status'] = {'name': issue['status']}
+    if (want('priority')):
+        f['priority'] = {'name': issue['priority']}
+    if (want('updated')):
+        f['updated'] = issue['updated'].strftime('%Y-%m-%dT%H:%M:%S.000-0400')
+    if (want('components')):
+        f['components'] = [{'name': issue['component']}]
+    if (want('timeestimate')):
+        f['timeestimate'] = issue.get('timeestimate')
+    if (want('issuelinks')):
+        f['issuelinks'] = []
+        for (linktype, direction, target) in issue['links']:
+            (type_id, outward, inward) = LINK_TYPES[linktype]
+            link = {'type': {'id': type_id, 'name': linktype, 'inward': inward, 'outward': outward}}
+            link[direction + 'Issue'] = {'id': str(10000 + int(target.split('-')[1])), 'key': target}
+            f['issuelinks'].append(link)
+    if (want(EPIC_LINK_FIELD)):
+        f[EPIC_LINK_FIELD] = issue.get('epic')
+    data['fields'] = f
+    data['renderedFields'] = rendered
+    return data
+
+
+def jql_values(text):
+    """List of the quoted or unquoted values in a JQL list like a, "b c"."""
+    return [v.strip().strip('"\'') for v in text.split(',')]
+
+
+def select_issues(issues, jql):
+    """Apply the parts of jql we understand.
+
+    These are key in (...), issuetype in (...), component = "..." and
+    updated >= "...". As in Jira, a key in (...) with a key that doesn't
+    exist raises ValueError.
+    """
+    m = re.search(r'\bkey\s+in\s*\(([^\)]*)\)', jql, flags=re.IGNORECASE)
+    if (m):
+        keys = set(jql_values(m.group(1)))
+        unknown = keys - set(i['key'] for i in issues)
+        if (unknown):
+            raise ValueError("An issue with key '%s' does not exist for field 'key'." % (sorted(unknown)[0]))
+        issues = [i for i in issues if i['key'] in keys]
+    m = re.search(r'\bissuetype\s+in\s*\(([^\)]*)\)', jql, flags=re.IGNORECASE)
+    if (m):
+        types = set(jql_values(m.group(1)))
+        issues = [i for i in issues if i['type'] in types]
+    m = re.search(r'\bcomponent\s*=\s*"([^"]+)"', jql, flags=re.IGNORECASE)
+    if (m):
+        issues = [i for i in issues if i['component'] == m.group(1)]
+    m = re.search(r'\bupdated\s*>=\s*"([^"]+)"', jql, flags=re.IGNORECASE)
+    if (m):
+        since = datetime.strptime(m.group(1), '%Y/%m/%d %H:%M')
+        issues = [i for i in issues if i['updated'] >= since]
+    return issues
+
+
+class FakeJiraHandler(BaseHTTPRequestHandler):
+    """Request handler, the server has attributes issues, latency and require_login."""
+
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def send_body(self, status, body, content_type, headers=None):
+        if (self.server.latency):
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def logged_in(self):
+        if (not self.server.require_login):
+            return True
+        cookie = self.headers.get('Cookie') or ''
+        return (SESSION_TOKEN + '=' + self.server.token) in cookie
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        if (urlsplit(self.path).path.rstrip('/').endswith('rest/auth/1/session')):
+            body = json.dumps({'session': {'name': SESSION_TOKEN, 'value': self.server.token}})
+            self.server.logins += 1
+            self.send_body(200, body.encode('utf-8'), 'application/json',
+                           {'Set-Cookie': '%s=%s; Max-Age=%d; Path=/' % (SESSION_TOKEN, self.server.token, SESSION_LIFETIME)})
+        else:
+            self.send_body(404, b'Not found', 'text/plain')
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        params = parse_qs(parts.query)
+        if (not self.logged_in()):
+            self.send_body(401, b'Unauthorized', 'text/plain')
+        elif (parts.path.endswith('SearchRequest.xml')):
+            self.search_xml(params)
+        elif (parts.path.rstrip('/').endswith('rest/api/2/search')):
+            self.search_json(params)
+        else:
+            self.send_body(404, b'Not found', 'text/plain')
+
+    def baseuri(self):
+        return 'http://%s/' % (self.headers.get('Host') or 'localhost')
+
+    def select(self, params):
+        """Issues selected by the jql param, else None after sending a 400 response."""
+        try:
+            return select_issues(self.server.issues, params.get('jql', [''])[0])
+        except ValueError as e:
+            self.send_body(400, json.dumps({'errorMessages': [str(e)]}).encode('utf-8'),
+                           'application/json')
+            return None
+
+    def search_xml(self, params):
+        issues = self.select(params)
+        if (issues is None):
+            return
+        start = int(params.get('pager/start', ['0'])[0])
+        page_size = min(int(params.get('tempMax', ['1000'])[0]), self.server.temp_max)
+        fields = frozenset(params.get('field', []))
+        page = issues[start:start + page_size]
+        baseuri = self.baseuri()
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>\n<rss version="0.92">\n<channel>\n'
+               '<title>Fake Jira</title>\n<link>%s</link>\n'
+               '<issue start="%d" end="%d" total="%d"/>\n' % (baseuri, start, start + len(page), len(issues))]
+        for issue in page:
+            xml.append(issue_to_xml(issue, baseuri, fields))
+        xml.append('</channel>\n</rss>\n')
+        self.send_body(200, ''.join(xml).encode('utf-8'), 'text/xml; charset=UTF-8')
+
+    def search_json(self, params):
+        issues = self.select(params)
+        if (issues is None):
+            return
+        start = int(params.get('startAt', ['0'])[0])
+        page_size = min(int(params.get('maxResults', ['50'])[0]), self.server.max_results)
+        fields = frozenset(','.join(params.get('fields', [])).split(',')) - set([''])
+        baseuri = self.baseuri()
+        data = {'startAt': start,
+                'maxResults': page_size,
+                'total': len(issues),
+                'issues': [issue_to_json(i, baseuri, fields) for i in issues[start:start + page_size]]}
+        self.send_body(200, json.dumps(data).encode('utf-8'), 'application/json')
+
+
+def make_server(issues, host='localhost', port=0, latency=0.0, max_results=100, temp_max=1000,
+                require_login=True):
+    """Create FakeJiraHandler server for issues, port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), FakeJiraHandler)
+    server.daemon_threads = True
+    server.issues = issues
+    server.latency = latency
+    server.max_results = max_results
+    server.temp_max = temp_max
+    server.require_login = require_login
+    server.token = 'fake%d' % (random.getrandbits(32))
+    server.logins = 0
+    return server
+
+
+def start_server(issues, **kwargs):
+    """Run server for issues in a background thread, returns (server, baseuri)."""
+    server = make_server(issues, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return (server, 'http://%s:%d/' % server.server_address[:2])
+
+
+CONFIG_TEMPLATE = """[irs_reporter]
+name = Fake Jira report
+username = fake
+password = fake
+baseuri = http://localhost:{port}/
+query = project = {project} ORDER BY key ASC
+"""
+
+
+def main():
+    parser = OptionParser(description="Run a stand-in Jira server with synthetic issues")
+    parser.add_option("-n", "--issues", type="int", default=1000,
+                      help="number of issues to generate (default %default)")
+    parser.add_option("--seed", type="int", default=1,
+                      help="random seed for generator (default %default)")
+    parser.add_option("-p", "--port", type="int", default=8080,
+                      help="port to listen on (default %default)")
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="seconds to wait before each response (default %default)")
+    parser.add_option("--max-results", dest="max_results", type="int", default=100,
+                      help="maximum page size for JSON search (default %default)")
+    parser.add_option("--temp-max", dest="temp_max", type="int", default=1000,
+                      help="maximum page size for XML search, as Jira's "
+                           "jira.search.views.default.max (default %default)")
+    parser.add_option("--no-login", dest="no_login", action="store_true",
+                      help="don't require a session cookie")
+    parser.add_option("--config", type="int", metavar="PORT",
+                      help="print irs_reporter.cfg for server on PORT and exit")
+    parser.add_option("--dump", metavar="FILE",
+                      help="write all issues as an XML view response to FILE and exit")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="be verbose")
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO)
+
+    if (options.config):
+        print(CONFIG_TEMPLATE.format(port=options.config, project=PROJECT))
+        return
+    t = time.time()
+    issues = generate_issues(options.issues, options.seed)
+    logging.info("Generated %d issues in %.1fs" % (len(issues), time.time() - t))
+    if (options.dump):
+        with open(options.dump, 'w') as fh:
+            fh.write('<?xml version="1.0" encoding="UTF-8"?>\n<rss version="0.92">\n<channel>\n'
+                     '<issue start="0" end="%d" total="%d"/>\n' % (len(issues), len(issues)))
+            for issue in issues:
+                fh.write(issue_to_xml(issue, 'http://localhost/', frozenset()))
+            fh.write('</channel>\n</rss>\n')
+        return
+    server = make_server(issues, port=options.port, latency=options.latency,
+                         max_results=options.max_results, temp_max=options.temp_max,
+                         require_login=not options.no_login)
+    logging.info("Serving fake Jira at http://localhost:%d/" % (options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
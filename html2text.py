@@ -30,7 +30,8 @@ try: #Python3
     import urllib.request as urllib
 except:
     import urllib
-import optparse, re, sys, codecs, types
+import contextlib, optparse, re, sys, codecs, threading, types
+from collections import deque
 
 try: from textwrap import wrap
 except: pass
@@ -87,6 +88,12 @@ unifiable_n = {}
 for k in unifiable.keys():
     unifiable_n[name2cp(k)] = unifiable[k]
 
+# The tables HTML2Text uses, which are never modified so that converters
+# can run in several threads. &nbsp; is replaced with a placeholder that
+# survives whitespace collapsing until close(), &#160; is left as is.
+entity_unifiable = dict(unifiable, nbsp='&nbsp_place_holder;')
+charref_unifiable = dict((k, v) for k, v in unifiable_n.items() if k != name2cp('nbsp'))
+
 ### End Entity Nonsense ###
 
 def onlywhite(line):
@@ -171,6 +178,13 @@ def google_fixed_width_font(style):
         return True
     return False
 
+def link_key(attrs):
+    """returns the key of a link (or image) for finding repeats of it, links
+    match if they have the same href and either the same title or no title"""
+    if 'title' in attrs:
+        return (attrs['href'], True, attrs['title'])
+    return (attrs['href'], False, None)
+
 def list_numbering_start(attrs):
     """extract numbering from list element attributes"""
     if 'start' in attrs:
@@ -178,6 +192,48 @@ def list_numbering_start(attrs):
     else:
         return 0
 
+class OutputBuffer(object):
+    """Output text kept as a list of chunks until getvalue().
+
+    As well as appending, the edits made at the end of the output when
+    closing emphasis, rstrip() and drop_last(), work on the chunks
+    without joining them, so each is amortized O(1).
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def append(self, s):
+        if s:
+            self.chunks.append(s)
+
+    def endswith(self, suffix):
+        """True if the last chunk ends with suffix (a single character)."""
+        return bool(self.chunks) and self.chunks[-1].endswith(suffix)
+
+    def rstrip(self):
+        """Remove trailing whitespace."""
+        chunks = self.chunks
+        while chunks:
+            s = chunks[-1].rstrip()
+            if s:
+                chunks[-1] = s
+                return
+            chunks.pop()
+
+    def drop_last(self, n):
+        """Remove the last n characters."""
+        chunks = self.chunks
+        while n > 0 and chunks:
+            s = chunks.pop()
+            if len(s) > n:
+                chunks.append(s[:-n])
+                return
+            n -= len(s)
+
+    def getvalue(self):
+        return u''.join(self.chunks)
+
 class HTML2Text(HTMLParser.HTMLParser):
     def __init__(self, out=None, baseurl=''):
         HTMLParser.HTMLParser.__init__(self)
@@ -194,6 +250,7 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.ignore_images = IGNORE_IMAGES
         self.ignore_emphasis = IGNORE_EMPHASIS
         self.google_doc = False
+        self.hide_strikethrough = False
         self.ul_item_mark = '*'
         self.emphasis_mark = '_'
         self.strong_mark = '**'
@@ -202,8 +259,17 @@ class HTML2Text(HTMLParser.HTMLParser):
             self.out = self.outtextf
         else:
             self.out = out
+        self.baseurl = baseurl
 
-        self.outtextlist = []  # empty list to store output characters before they are "joined"
+    def reset(self):
+        """Clear all parsing and output state, keeping the config options.
+
+        Called by HTMLParser.__init__, and may be called after handle() so
+        that one converter can be used for many documents.
+        """
+        HTMLParser.HTMLParser.reset(self)
+
+        self.outbuf = OutputBuffer()  # output before it is "joined"
 
         try:
             self.outtext = unicode()
@@ -215,10 +281,11 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.outcount = 0
         self.start = 1
         self.space = 0
-        self.a = []
+        self.a = deque()  # links waiting to be written, in outcount order
+        self.a_index = {}  # the same links by link_key()
         self.astack = []
         self.maybe_automatic_link = None
-        self.absolute_url_matcher = re.compile(r'^[a-zA-Z+]+://')
+        self.absolute_url_matcher = absolute_url_matcher
         self.acount = 0
         self.list = []
         self.blockquote = 0
@@ -237,12 +304,6 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.abbr_title = None  # current abbreviation definition
         self.abbr_data = None  # last inner HTML (for abbr being defined)
         self.abbr_list = {}  # stack of abbreviations to write later
-        self.baseurl = baseurl
-
-        try: del unifiable_n[name2cp('nbsp')]
-        except KeyError: pass
-        unifiable['nbsp'] = '&nbsp_place_holder;'
-
 
     def feed(self, data):
         data = data.replace("</' + 'script>", "</ignore>")
@@ -254,7 +315,7 @@ class HTML2Text(HTMLParser.HTMLParser):
         return self.optwrap(self.close())
 
     def outtextf(self, s):
-        self.outtextlist.append(s)
+        self.outbuf.append(s)
         if s: self.lastWasNL = s[-1] == '\n'
 
     def close(self):
@@ -263,7 +324,7 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.pbr()
         self.o('', 0, 'end')
 
-        self.outtext = self.outtext.join(self.outtextlist)
+        self.outtext = self.outbuf.getvalue()
         if self.unicode_snob:
             nbsp = unichr(name2cp('nbsp'))
         else:
@@ -284,32 +345,31 @@ class HTML2Text(HTMLParser.HTMLParser):
     def handle_endtag(self, tag):
         self.handle_tag(tag, None, 0)
 
-    def previousIndex(self, attrs):
-        """ returns the index of certain set of attributes (of a link) in the
-            self.a list
-
-            If the set of attributes is not found, returns None
+    def previousLink(self, attrs):
+        """ returns the link with the same href and title as attrs that is
+            waiting to be written, else None
         """
         if not has_key(attrs, 'href'): return None
+        return self.a_index.get(link_key(attrs))
 
-        i = -1
-        for a in self.a:
-            i += 1
-            match = 0
-
-            if has_key(a, 'href') and a['href'] == attrs['href']:
-                if has_key(a, 'title') or has_key(attrs, 'title'):
-                        if (has_key(a, 'title') and has_key(attrs, 'title') and
-                            a['title'] == attrs['title']):
-                            match = True
-                else:
-                    match = True
-
-            if match: return i
+    def addLink(self, attrs):
+        """ numbers the link attrs and adds it to those waiting to be written """
+        self.acount += 1
+        attrs['count'] = self.acount
+        attrs['outcount'] = self.outcount
+        self.a.append(attrs)
+        self.a_index[link_key(attrs)] = attrs
 
     def drop_last(self, nLetters):
         if not self.quiet:
-            self.outtext = self.outtext[:-nLetters]
+            self.outbuf.drop_last(nLetters)
+            self.lastWasNL = self.outbuf.endswith('\n')
+
+    def rstrip_output(self):
+        """Remove whitespace from the end of the output so far."""
+        if not self.quiet:
+            self.outbuf.rstrip()
+            self.lastWasNL = self.outbuf.endswith('\n')
 
     def handle_emphasis(self, start, tag_style, parent_style):
         """handles various text emphases"""
@@ -345,7 +405,7 @@ class HTML2Text(HTMLParser.HTMLParser):
                 # there must not be whitespace before closing emphasis mark
                 self.emphasis -= 1
                 self.space = 0
-                self.outtext = self.outtext.rstrip()
+                self.rstrip_output()
             if fixed:
                 if self.drop_white_space:
                     # empty emphasis, drop it
@@ -483,14 +543,11 @@ class HTML2Text(HTMLParser.HTMLParser):
                         if self.inline_links:
                             self.o("](" + escape_md(a['href']) + ")")
                         else:
-                            i = self.previousIndex(a)
-                            if i is not None:
-                                a = self.a[i]
+                            link = self.previousLink(a)
+                            if link is not None:
+                                a = link
                             else:
-                                self.acount += 1
-                                a['count'] = self.acount
-                                a['outcount'] = self.outcount
-                                self.a.append(a)
+                                self.addLink(a)
                             self.o("][" + str(a['count']) + "]")
 
         if tag == "img" and start and not self.ignore_images:
@@ -502,14 +559,11 @@ class HTML2Text(HTMLParser.HTMLParser):
                 if self.inline_links:
                     self.o("(" + escape_md(attrs['href']) + ")")
                 else:
-                    i = self.previousIndex(attrs)
-                    if i is not None:
-                        attrs = self.a[i]
+                    link = self.previousLink(attrs)
+                    if link is not None:
+                        attrs = link
                     else:
-                        self.acount += 1
-                        attrs['count'] = self.acount
-                        attrs['outcount'] = self.outcount
-                        self.a.append(attrs)
+                        self.addLink(attrs)
                     self.o("[" + str(attrs['count']) + "]")
 
         if tag == 'dl' and start: self.p()
@@ -636,18 +690,17 @@ class HTML2Text(HTMLParser.HTMLParser):
             if self.a and ((self.p_p == 2 and self.links_each_paragraph) or force == "end"):
                 if force == "end": self.out("\n")
 
-                newa = []
-                for link in self.a:
-                    if self.outcount > link['outcount']:
-                        self.out("   ["+ str(link['count']) +"]: " + urlparse.urljoin(self.baseurl, link['href']))
-                        if has_key(link, 'title'): self.out(" ("+link['title']+")")
-                        self.out("\n")
-                    else:
-                        newa.append(link)
-
-                if self.a != newa: self.out("\n") # Don't need an extra line when nothing was done.
+                # links are in outcount order so those to write come first
+                flushed = False
+                while self.a and self.outcount > self.a[0]['outcount']:
+                    link = self.a.popleft()
+                    del self.a_index[link_key(link)]
+                    self.out("   ["+ str(link['count']) +"]: " + urlparse.urljoin(self.baseurl, link['href']))
+                    if has_key(link, 'title'): self.out(" ("+link['title']+")")
+                    self.out("\n")
+                    flushed = True
 
-                self.a = newa
+                if flushed: self.out("\n") # Don't need an extra line when nothing was done.
 
             if self.abbr_list and force == "end":
                 for abbr, definition in self.abbr_list.items():
@@ -684,8 +737,8 @@ class HTML2Text(HTMLParser.HTMLParser):
         else:
             c = int(name)
 
-        if not self.unicode_snob and c in unifiable_n.keys():
-            return unifiable_n[c]
+        if not self.unicode_snob and c in charref_unifiable:
+            return charref_unifiable[c]
         else:
             try:
                 return unichr(c)
@@ -693,8 +746,8 @@ class HTML2Text(HTMLParser.HTMLParser):
                 return chr(c)
 
     def entityref(self, c):
-        if not self.unicode_snob and c in unifiable.keys():
-            return unifiable[c]
+        if not self.unicode_snob and c in entity_unifiable:
+            return entity_unifiable[c]
         else:
             try: name2cp(c)
             except KeyError: return "&" + c + ';'
@@ -728,28 +781,34 @@ class HTML2Text(HTMLParser.HTMLParser):
             return text
 
         assert wrap, "Requires Python 2.3."
-        result = ''
+        result = []
         newlines = 0
         for para in text.split("\n"):
             if len(para) > 0:
                 if not skipwrap(para):
-                    result += "\n".join(wrap(para, self.body_width))
+                    result.append("\n".join(wrap_para(para, self.body_width)))
                     if para.endswith('  '):
-                        result += "  \n"
+                        result.append("  \n")
                         newlines = 1
                     else:
-                        result += "\n\n"
+                        result.append("\n\n")
                         newlines = 2
                 else:
                     if not onlywhite(para):
-                        result += para + "\n"
+                        result.append(para + "\n")
                         newlines = 1
             else:
                 if newlines < 2:
-                    result += "\n"
+                    result.append("\n")
                     newlines += 1
-        return result
-
+        return ''.join(result)
+
+absolute_url_matcher = re.compile(r'^[a-zA-Z+]+://')
+plain_para_matcher = re.compile(r'[\x20-\x7e]*\Z')
+hyphen_break_matcher = re.compile(r'-[-A-Za-z_]')
+spaces_matcher = re.compile(r' *')
+# textwrap breaks words too long for a line after a hyphen from Python 3.10
+wrap_splits_long_words_at_hyphens = wrap('aa-11111', 5) == ['aa-', '11111']
 ordered_list_matcher = re.compile(r'\d+\.\s')
 unordered_list_matcher = re.compile(r'[-\*\+]\s')
 md_chars_matcher = re.compile(r"([\\\[\]\(\)])")
@@ -800,6 +859,66 @@ def skipwrap(para):
         return True
     return False
 
+def wrap_para(para, width):
+    """Lines of para wrapped at width, the same as textwrap.wrap(para, width).
+
+    Paragraphs of printable ASCII, the usual case, are split into lines
+    here with string searches rather than by textwrap chunk by chunk.
+    Those with hyphens that textwrap may break words at (before a letter
+    or another hyphen, as in "well-known" or "--") are left to textwrap,
+    as is text with tabs or other whitespace. So are those with a word too
+    long for a line that has a hyphen in it, unless textwrap splits such
+    words after the hyphen which is done here too.
+    """
+    if not plain_para_matcher.match(para) or hyphen_break_matcher.search(para):
+        return wrap(para, width)
+    lines = []
+    n = len(para)
+    i = 0
+    while i < n:
+        if lines and para[i] == ' ':
+            # drop whitespace at the start of all but the first line
+            i = spaces_matcher.match(para, i).end()
+            if i == n:
+                break
+        limit = i + width
+        end = n
+        if limit < n:
+            # end after the last whole word or run of spaces that fits
+            if para[limit] == ' ':
+                end = i + len(para[i:limit].rstrip(' '))
+            else:
+                end = para.rfind(' ', i, limit) + 1 or i
+            # then split the next word (or spaces) if too long for any line,
+            # a split part that is spaces (or empty) is dropped
+            if para[end] == ' ':
+                too_long = not para[end:end + width + 1].strip(' ')
+            else:
+                too_long = ' ' not in para[end:end + width + 1]
+            if too_long and end + width < n:
+                split = limit
+                if para[end] != ' ' and not wrap_splits_long_words_at_hyphens:
+                    word_end = para.find(' ', end)
+                    if '-' in para[end:word_end if word_end >= 0 else n]:
+                        return wrap(para, width)
+                elif para[end] != ' ':
+                    # break after the last hyphen if not all hyphens before it
+                    hyphen = para.rfind('-', end + 1, limit)
+                    if hyphen > 0 and para[end:hyphen].strip('-'):
+                        split = hyphen + 1
+                if para[end] != ' ' and split > end:
+                    lines.append(para[i:split])
+                elif end > i:
+                    lines.append(para[i:end])
+                i = split
+                continue
+        # drop spaces at the end of the line
+        line = para[i:end].rstrip(' ')
+        if line:
+            lines.append(line)
+        i = end
+    return lines
+
 def wrapwrite(text):
     text = text.encode('utf-8')
     try: #Python3
@@ -811,6 +930,48 @@ def html2text(html, baseurl=''):
     h = HTML2Text(baseurl=baseurl)
     return h.handle(html)
 
+class HTML2TextPool(object):
+    """Pool of HTML2Text converters that are reused rather than created per document.
+
+    Each converter is made with the config options given as keyword
+    arguments and is reset() when returned to the pool. Converters share
+    no mutable state so the pool may be used from several threads:
+
+        pool = HTML2TextPool(body_width=0)
+        with pool.converter() as h:
+            text = h.handle(html)
+    """
+
+    def __init__(self, baseurl='', **options):
+        self.baseurl = baseurl
+        self.options = options
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Return a converter from the pool, or a new one if none are free."""
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        h = HTML2Text(baseurl=self.baseurl)
+        for name, value in self.options.items():
+            setattr(h, name, value)
+        return h
+
+    def release(self, h):
+        """Reset converter h and return it to the pool."""
+        h.reset()
+        with self.lock:
+            self.free.append(h)
+
+    @contextlib.contextmanager
+    def converter(self):
+        h = self.acquire()
+        try:
+            yield h
+        finally:
+            self.release(h)
+
 def unescape(s, unicode_snob=False):
     h = HTML2Text()
     h.unicode_snob = unicode_snob
@@ -0,0 +1,492 @@
+"""Graphs of issue links for priority propagation and planning queries.
+
+PriorityGraph is built from the 'Relies on' and 'Is relied upon by' links of
+each issue as parsed by parse_issue_links() in story_feature_policy_report.py.
+An edge goes from the dependent issue (e.g. a user story) to the issue it
+relies on (e.g. a feature or policy). Either direction of link is enough
+to make the edge, links to issues not in the graph are recorded in
+dangling.
+
+Priorities are handled as numeric values (higher is more important) so
+that this module doesn't depend on the names used in Jira.
+
+LinkGraph is a compact form of all links, with issues numbered and the
+targets of each link type in flat arrays, for queries over large projects
+such as which stories are affected by a feature.
+
+Python3 only.
+"""
+
+from array import array
+from collections import deque
+from heapq import heappush, heappop
+
+RELIES_ON = 'Relies on'
+RELIED_UPON_BY = 'Is relied upon by'
+EPIC_MEMBER = 'Has epic member'  # LinkGraph only, from epic to issues in it
+
+
+class PriorityGraph(object):
+    """Graph of which issues rely on which, with a priority value for each.
+
+    issues is an iterable of issue dicts with at least key, type, priority
+    and issuelinks (or links_field), values maps priority names to numbers.
+    Edges are made from the links of linktypes, by default both directions.
+
+    The results of infer_max() and infer_min() are kept (inferred, effective
+    and lowest) so that update() can re-infer after a few priorities change
+    by looking only at the issues reachable from those changed.
+    """
+
+    def __init__(self, issues, values, linktypes=(RELIES_ON, RELIED_UPON_BY),
+                 links_field='issuelinks'):
+        self.values = values
+        self.links_field = links_field
+        self.issues = {}
+        self.types = {}
+        self.value = {}
+        self.dependents = {}
+        self.dependencies = {}
+        self.dangling = []
+        links = []
+        for issue in issues:
+            key = issue['key']
+            self.issues[key] = issue
+            self.types[key] = issue['type']
+            self.value[key] = values[issue['priority']]
+            self.dependents[key] = []
+            self.dependencies[key] = []
+            issuelinks = issue.get(links_field) or {}
+            if (RELIES_ON in linktypes):
+                for target in issuelinks.get(RELIES_ON, []):
+                    links.append((key, target))
+            if (RELIED_UPON_BY in linktypes):
+                for target in issuelinks.get(RELIED_UPON_BY, []):
+                    links.append((target, key))
+        seen = set()
+        for (dependent, dependency) in links:
+            if ((dependent, dependency) in seen):
+                continue
+            seen.add((dependent, dependency))
+            if (dependent not in self.types or dependency not in self.types):
+                self.dangling.append((dependent, dependency))
+                continue
+            self.dependents[dependency].append(dependent)
+            self.dependencies[dependent].append(dependency)
+        (order, self.cyclic) = self.order()
+        self.position = dict((key, n) for (n, key) in enumerate(order))
+        self.max_types = ()
+        self.modify = False
+        self.inferred = {}
+        self.effective = dict(self.value)
+        self.lowest = {}
+
+    def order(self):
+        """Topological order with dependents before the issues they rely on.
+
+        Returns (order, cyclic) where cyclic is the list of keys that can't
+        be ordered because they are on, or rely on, a cycle.
+        """
+        waiting = dict((key, len(dependents)) for (key, dependents) in self.dependents.items())
+        ready = deque(key for (key, n) in waiting.items() if n == 0)
+        order = []
+        while (ready):
+            key = ready.popleft()
+            order.append(key)
+            for dependency in self.dependencies[key]:
+                waiting[dependency] -= 1
+                if (waiting[dependency] == 0):
+                    ready.append(dependency)
+        cyclic = [key for (key, n) in waiting.items() if n > 0]
+        return(order, cyclic)
+
+    def cycles(self):
+        """List of cycles, each a sorted list of the keys of issues in the cycle.
+
+        Uses Tarjan's algorithm (iteratively) to find the strongly connected
+        components with more than one issue, or a self link.
+        """
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+        counter = 0
+        for root in self.dependencies:
+            if (root in index):
+                continue
+            work = [(root, 0)]
+            while (work):
+                (key, i) = work.pop()
+                if (i == 0):
+                    index[key] = low[key] = counter
+                    counter += 1
+                    stack.append(key)
+                    on_stack.add(key)
+                recurse = False
+                dependencies = self.dependencies[key]
+                while (i < len(dependencies)):
+                    dependency = dependencies[i]
+                    i += 1
+                    if (dependency not in index):
+                        work.append((key, i))
+                        work.append((dependency, 0))
+                        recurse = True
+                        break
+                    elif (dependency in on_stack):
+                        low[key] = min(low[key], index[dependency])
+                if (recurse):
+                    continue
+                if (low[key] == index[key]):
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if (member == key):
+                            break
+                    if (len(component) > 1 or key in self.dependencies[key]):
+                        cycles.append(sorted(component))
+                if (work):
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[key])
+        return(cycles)
+
+    def infer_max(self, types, modify=True):
+        """Infer priorities from the issues that rely on each issue.
+
+        For each issue of one of types the inferred value is the highest
+        effective value of the issues that rely on it. The effective value
+        of an issue is its own value, raised to the inferred value if that
+        is higher and modify is set. This is done in one pass in topological
+        order so chains of any length are followed. Issues on cycles are
+        then iterated to a fixed point, which terminates as values only
+        increase.
+
+        Returns (inferred, effective), dicts of key to value where inferred
+        has only the issues of types that have dependents.
+        """
+        self.max_types = types
+        self.modify = modify
+        self.inferred = {}
+        self.effective = dict(self.value)
+        for key in sorted(self.position, key=self.position.get):
+            self.set_max(key)
+        self.max_fixed_point(self.cyclic)
+        return(self.inferred, self.effective)
+
+    def set_max(self, key):
+        """Set inferred and effective values of key from its dependents.
+
+        Returns (inferred_changed, effective_changed).
+        """
+        own = self.value[key]
+        dependents = self.dependents[key]
+        inferred = None
+        effective = own
+        if (self.types[key] in self.max_types and dependents):
+            inferred = max(self.effective[d] for d in dependents)
+            if (self.modify and inferred > own):
+                effective = inferred
+        inferred_changed = (inferred != self.inferred.get(key))
+        if (inferred is None):
+            self.inferred.pop(key, None)
+        else:
+            self.inferred[key] = inferred
+        effective_changed = (effective != self.effective[key])
+        self.effective[key] = effective
+        return(inferred_changed, effective_changed)
+
+    def max_fixed_point(self, keys):
+        """Iterate set_max() over keys, which include all their dependencies."""
+        for key in keys:
+            self.effective[key] = self.value[key]
+        pending = deque(keys)
+        queued = set(keys)
+        while (pending):
+            key = pending.popleft()
+            queued.discard(key)
+            if (self.set_max(key)[1]):
+                for dependency in self.dependencies[key]:
+                    if (dependency not in queued):
+                        pending.append(dependency)
+                        queued.add(dependency)
+
+    def infer_min(self, types):
+        """Infer priorities from the issues each issue relies on.
+
+        For each issue of one of types the inferred value is the lowest
+        effective value of the issues it relies on, directly or through
+        chains of dependencies. Effective values are those from the last
+        infer_max(), else the issues' own values.
+
+        Returns dict of key to value for the issues of types that rely on
+        anything.
+        """
+        self.lowest = {}
+        # Issues on cycles, and those they rely on, can only rely on each other
+        self.min_fixed_point(self.cyclic)
+        for key in sorted(self.position, key=self.position.get, reverse=True):
+            self.set_min(key)
+        return(dict((key, value) for (key, value) in self.lowest.items() if self.types[key] in types))
+
+    def set_min(self, key):
+        """Set lowest value of all dependencies of key, return True if changed."""
+        values = []
+        for dependency in self.dependencies[key]:
+            values.append(self.effective[dependency])
+            if (dependency in self.lowest):
+                values.append(self.lowest[dependency])
+        lowest = min(values) if values else None
+        if (lowest == self.lowest.get(key)):
+            return False
+        if (lowest is None):
+            del self.lowest[key]
+        else:
+            self.lowest[key] = lowest
+        return True
+
+    def min_fixed_point(self, keys):
+        """Iterate set_min() over keys, which include all their dependencies."""
+        for key in keys:
+            self.lowest.pop(key, None)
+        changed = True
+        while (changed):
+            changed = False
+            for key in keys:
+                if (self.set_min(key)):
+                    changed = True
+
+    def closure(self, keys, adjacency, within=None):
+        """Set of keys and all issues reachable from them through adjacency.
+
+        If within is given then only issues in within are followed.
+        """
+        reached = set(keys)
+        pending = list(keys)
+        while (pending):
+            for other in adjacency[pending.pop()]:
+                if (other not in reached and (within is None or other in within)):
+                    reached.add(other)
+                    pending.append(other)
+        return(reached)
+
+    def update(self, changes):
+        """Change the values of some issues and re-infer incrementally.
+
+        changes is a dict of key to new value. Starting from the results
+        of the last infer_max() and infer_min(), only issues that rely on,
+        or are relied on by, an issue whose result changes are re-evaluated,
+        in topological order. Issues on cycles, which have no order, are
+        re-evaluated together if any is reached.
+
+        Returns the set of keys whose value, inferred, effective or lowest
+        value changed.
+        """
+        changed = set()
+        effective_changed = set()
+        heap = []
+        cyclic = set()
+        for (key, value) in changes.items():
+            if (value != self.value[key]):
+                self.value[key] = value
+                changed.add(key)
+                if (key in self.position):
+                    heappush(heap, (self.position[key], key))
+                else:
+                    cyclic.add(key)
+        # Effective values, dependents before dependencies
+        while (heap):
+            (n, key) = heappop(heap)
+            (inferred_changed, effective_changed_here) = self.set_max(key)
+            if (inferred_changed or effective_changed_here):
+                changed.add(key)
+            if (effective_changed_here):
+                effective_changed.add(key)
+                for dependency in self.dependencies[key]:
+                    if (dependency in self.position):
+                        heappush(heap, (self.position[dependency], dependency))
+                    else:
+                        cyclic.add(dependency)
+        if (cyclic):
+            keys = self.closure(cyclic, self.dependencies)
+            before = dict((key, (self.inferred.get(key), self.effective[key])) for key in keys)
+            self.max_fixed_point(list(keys))
+            for key in keys:
+                (inferred, effective) = before[key]
+                if (inferred != self.inferred.get(key) or effective != self.effective[key]):
+                    changed.add(key)
+                if (effective != self.effective[key]):
+                    effective_changed.add(key)
+        # Lowest values, dependencies before dependents. Only issues on
+        # cycles and issues that rely on them can rely on issues on cycles
+        # so those are done first.
+        dirty = set()
+        for key in effective_changed:
+            dirty.update(self.dependents[key])
+        cyclic = [key for key in dirty if key not in self.position]
+        heap = [(-self.position[key], key) for key in dirty if key in self.position]
+        if (cyclic):
+            keys = list(self.closure(cyclic, self.dependents, set(self.cyclic)))
+            before = dict((key, self.lowest.get(key)) for key in keys)
+            self.min_fixed_point(keys)
+            for key in keys:
+                if (before[key] != self.lowest.get(key)):
+                    changed.add(key)
+                    for dependent in self.dependents[key]:
+                        if (dependent in self.position):
+                            heap.append((-self.position[dependent], dependent))
+        heap.sort()
+        done = set()
+        while (heap):
+            (n, key) = heappop(heap)
+            if (key in done):
+                continue
+            done.add(key)
+            if (self.set_min(key)):
+                changed.add(key)
+                for dependent in self.dependents[key]:
+                    heappush(heap, (-self.position[dependent], dependent))
+        return(changed)
+
+
+class LinkGraph(object):
+    """Links between issues as arrays indexed by integer issue id.
+
+    Issue ids are the order of issues, keys[id] is the key. For each link
+    type the links are stored CSR style: the targets of issue id are
+    targets[offsets[id]:offsets[id + 1]], and the same for the reverse of
+    each link type. Links to issues not in issues are dropped and counted
+    in dangling.
+
+    epic_of is an optional dict of issue key to the key of its epic, used
+    for the queries by epic.
+    """
+
+    def __init__(self, issues, epic_of=None):
+        issues = list(issues)
+        self.keys = [issue['key'] for issue in issues]
+        self.ids = dict((key, n) for (n, key) in enumerate(self.keys))
+        self.type_names = []
+        self.type_of = array('b')
+        for issue in issues:
+            if (issue['type'] not in self.type_names):
+                self.type_names.append(issue['type'])
+            self.type_of.append(self.type_names.index(issue['type']))
+        self.dangling = 0
+        pairs = {}
+        for (n, issue) in enumerate(issues):
+            for (linktype, targets) in (issue.get('issuelinks') or {}).items():
+                for target in targets:
+                    if (target in self.ids):
+                        pairs.setdefault(linktype, []).append((n, self.ids[target]))
+                    else:
+                        self.dangling += 1
+        if (epic_of):
+            for (key, epic) in epic_of.items():
+                if (key in self.ids and epic in self.ids):
+                    pairs.setdefault(EPIC_MEMBER, []).append((self.ids[epic], self.ids[key]))
+        self.links = {}
+        self.reverse = {}
+        for (linktype, edges) in pairs.items():
+            self.links[linktype] = self.csr(edges)
+            self.reverse[linktype] = self.csr([(b, a) for (a, b) in edges])
+
+    def csr(self, edges):
+        """(offsets, targets) arrays for edges, a list of (source, target) ids."""
+        counts = array('l', bytes(array('l').itemsize * (len(self.keys) + 1)))
+        for (source, target) in edges:
+            counts[source + 1] += 1
+        for n in range(len(self.keys)):
+            counts[n + 1] += counts[n]
+        offsets = array('l', counts)
+        targets = array('l', bytes(array('l').itemsize * len(edges)))
+        for (source, target) in edges:
+            targets[counts[source]] = target
+            counts[source] += 1
+        return(offsets, targets)
+
+    def id(self, key):
+        """Integer id of issue key, raise KeyError if not in graph."""
+        try:
+            return(self.ids[key])
+        except KeyError:
+            raise KeyError("Cannot find %s in link graph" % (key))
+
+    def type_mask(self, types):
+        """bytearray with 1 for the type numbers of type names in types."""
+        mask = bytearray(len(self.type_names))
+        for (n, name) in enumerate(self.type_names):
+            if (name in types):
+                mask[n] = 1
+        return(mask)
+
+    def reach(self, starts, forward=(), backward=()):
+        """Ids of issues reachable from ids starts, not including them.
+
+        Links of the linktypes in forward are followed from source to
+        target, those in backward from target to source.
+        """
+        adjacency = [self.links[linktype] for linktype in forward if linktype in self.links]
+        adjacency += [self.reverse[linktype] for linktype in backward if linktype in self.reverse]
+        seen = bytearray(len(self.keys))
+        for n in starts:
+            seen[n] = 1
+        reached = array('l')
+        pending = deque(starts)
+        while (pending):
+            n = pending.popleft()
+            for (offsets, targets) in adjacency:
+                for m in targets[offsets[n]:offsets[n + 1]]:
+                    if (not seen[m]):
+                        seen[m] = 1
+                        reached.append(m)
+                        pending.append(m)
+        return(reached)
+
+    def select(self, ids, types):
+        """Keys, in id order, of the issues ids whose types are in types."""
+        mask = self.type_mask(types)
+        type_of = self.type_of
+        return([self.keys[n] for n in sorted(ids) if mask[type_of[n]]])
+
+    def affected(self, key, types=('User Story',)):
+        """Keys of issues of types that rely on issue key, directly or not.
+
+        Uses both directions of link so that links dropped from one side,
+        e.g. by add_story_epics(), are still followed.
+        """
+        reached = self.reach([self.id(key)], forward=(RELIED_UPON_BY,), backward=(RELIES_ON,))
+        return(self.select(reached, types))
+
+    def relied_on(self, starts):
+        """Ids of issues directly relied on by issue ids starts."""
+        adjacency = []
+        if (RELIES_ON in self.links):
+            adjacency.append(self.links[RELIES_ON])
+        if (RELIED_UPON_BY in self.reverse):
+            adjacency.append(self.reverse[RELIED_UPON_BY])
+        seen = bytearray(len(self.keys))
+        ids = array('l')
+        for n in starts:
+            for (offsets, targets) in adjacency:
+                for m in targets[offsets[n]:offsets[n + 1]]:
+                    if (not seen[m]):
+                        seen[m] = 1
+                        ids.append(m)
+        return(ids)
+
+    def members(self, epic):
+        """Ids of the issues in epic (a key)."""
+        if (EPIC_MEMBER not in self.links):
+            return(array('l'))
+        (offsets, targets) = self.links[EPIC_MEMBER]
+        n = self.id(epic)
+        return(targets[offsets[n]:offsets[n + 1]])
+
+    def shared(self, epic_a, epic_b, types=('Feature',)):
+        """Keys of issues of types relied on by issues in both epics (keys)."""
+        in_a = bytearray(len(self.keys))
+        for n in self.relied_on(self.members(epic_a)):
+            in_a[n] = 1
+        return(self.select([n for n in self.relied_on(self.members(epic_b)) if in_a[n]], types))
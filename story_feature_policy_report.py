@@ -8,34 +8,231 @@ Simeon Warner, 2015-09.., 2017-09..
 
 import sys
 import re
-from urllib.parse import urlencode, urljoin
-from urllib.request import urlopen, Request
+import string
+from urllib.parse import urlencode, urljoin, urlsplit, urlunsplit, unquote
+from urllib.error import HTTPError
+from urllib.request import getproxies, proxy_bypass
+from http.cookies import SimpleCookie, CookieError
+from email.utils import parsedate_to_datetime
+import http.client
+import threading
 from configparser import RawConfigParser
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+import cProfile
 import xml.etree.ElementTree as ElementTree
+import base64
+import copy
 import getpass
+import hashlib
 import json
 import logging
+import sqlite3
 from optparse import OptionParser, OptionGroup
 import html2text
-from datetime import datetime, date
+from issue_graph import PriorityGraph, LinkGraph
+from datetime import datetime, date, timedelta
 import os
 import sys
+import time
+import tracemalloc
 
-if sys.version_info < (3, 3):
-    raise Exception("Must use python 3.3 or greater")
+if sys.version_info < (3, 9):
+    raise Exception("Must use python 3.9 or greater")
 
 # Global setup
 PRIORITY_TO_VALUE = {'Critical': 3, 'Major': 2, 'Low': 1}
 VALUE_TO_PRIORITY = dict((v, k) for k, v in PRIORITY_TO_VALUE.items())
 PRIORITIES = sorted(PRIORITY_TO_VALUE.keys(), key=lambda x: -
                     PRIORITY_TO_VALUE[x])  # highest first
+EPIC_LINK_FIELD = 'customfield_10730'
+ISSUE_TYPES = ['Feature', 'Policy', 'User Story', 'Epic']  # after split_jira_results()
+JIRA_ISSUE_TYPES = ['New Feature', 'Policy Question', 'User Story', 'Epic']  # as named in Jira
+LINKED_BATCH_SIZE = 100  # keys in each key in (...) query for linked issues
+CACHE_MAX_AGE = 30 * 24 * 3600  # seconds unused before cache entries are removed
+
+# Templates for each issue in the report, see also templates/irs_*.tpl
+FEATURE_TEMPLATE = """{keytarget}
+\subsubsection{{Feature: {summary} ({key}, {priority})}}
 
+{description}
+{related}
 
-def html_to_tex(html):
+"""
+
+POLICY_TEMPLATE = """{keytarget}
+\subsubsection{{Policy: {summary} ({key}, {priority})}}
+
+{description}
+{related}
+
+"""
+
+USER_STORY_TEMPLATE = """{keytarget}
+\subsubsection{{User story: {description} ({key}, {epic_name}, {priority})}}
+
+{related}
+
+"""
+
+# Jira fields needed to build the report whatever the templates use:
+# type to split the results, summary and description, priority and
+# issuelinks for priority inference, epic link to group user stories,
+# timetracking for effort estimates
+REQUIRED_FIELDS = ['key', 'type', 'summary', 'description', 'priority',
+                   'issuelinks', 'timetracking', EPIC_LINK_FIELD]
+
+# Jira fields needed for each template placeholder, where different from
+# the placeholder name, as many are derived
+TEMPLATE_FIELDS = {
+    'num': [],
+    'keytarget': ['key'],
+    'keyref': ['key'],
+    'related': ['issuelinks'],
+    'epic': [EPIC_LINK_FIELD],
+    'epic_name': [EPIC_LINK_FIELD],
+    'epic_ref': [EPIC_LINK_FIELD],
+    'days': ['timetracking'],
+    'timeestimate': ['timetracking'],
+}
+
+# Fields of the XML view that may be requested, see
+# https://confluence.atlassian.com/jira/displaying-search-results-in-xml-185729644.html
+XML_FIELDS = set(['key', 'type', 'summary', 'description', 'status', 'link',
+                  'component', 'priority', 'issuelinks', 'timetracking',
+                  'resolution', 'assignee', 'reporter', 'labels', 'created',
+                  'updated', 'due', 'version', 'fixVersion', 'environment'])
+
+
+def template_placeholders(template):
+    """Set of field names used in str.format() placeholders in template."""
+    names = set()
+    for (literal, name, spec, conversion) in string.Formatter().parse(template):
+        if (name):
+            names.add(re.split(r'[\.\[]', name)[0])
+    return(names)
+
+
+def report_fields(templates, epic_link_field=EPIC_LINK_FIELD):
+    """Minimal list of Jira fields needed to build report from the issue templates.
+
+    The templates are formatted with the args of each issue so their
+    placeholders are mapped to Jira fields with TEMPLATE_FIELDS, or used
+    as is if they are XML view fields or custom fields. The placeholders in
+    the wrapper template are filled from the config and rendered issues so
+    it doesn't add to the fields needed. epic_link_field is used in place
+    of EPIC_LINK_FIELD.
+    """
+    fields = [epic_link_field if f == EPIC_LINK_FIELD else f for f in REQUIRED_FIELDS]
+    names = set()
+    for template in templates:
+        names.update(template_placeholders(template))
+    for name in sorted(names):
+        if (name in TEMPLATE_FIELDS):
+            needed = [epic_link_field if f == EPIC_LINK_FIELD else f for f in TEMPLATE_FIELDS[name]]
+        elif (name in XML_FIELDS or name.startswith('customfield_')):
+            needed = [name]
+        else:
+            logging.warn("Template placeholder {%s} is not a known Jira field" % (name))
+            needed = []
+        for field in needed:
+            if (field not in fields):
+                fields.append(field)
+    return(fields)
+
+
+class Profile(object):
+    """Wall time, CPU time and peak memory for each pipeline stage, plus counters.
+
+    Does nothing unless enabled so that the calls can be left in place.
+    Stages may be nested, and a stage name used more than once (e.g. for
+    each page of results) accumulates. Peak memory is recorded only
+    for top level stages, and only if tracemalloc is tracing.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.depth = 0
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        """Add n to counter name, may be called from several threads."""
+        if (self.enabled):
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def add(self, name, wall, cpu, peak=None):
+        """Add times (and peak memory) to stage name."""
+        stage = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+        stage['calls'] += 1
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        if (peak is not None):
+            stage['peak_kb'] = max(stage.get('peak_kb', 0), peak // 1024)
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager to record time and memory for stage name."""
+        if (not self.enabled):
+            yield
+            return
+        track_memory = (self.depth == 0 and tracemalloc.is_tracing())
+        if (track_memory):
+            tracemalloc.reset_peak()
+        self.depth += 1
+        t0 = time.perf_counter()
+        c0 = time.process_time()
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            peak = tracemalloc.get_traced_memory()[1] if track_memory else None
+            self.add(name, time.perf_counter() - t0, time.process_time() - c0, peak)
+
+    def iterate(self, name, iterable):
+        """Wrap iterable to record the time taken to get each value as stage name.
+
+        Used to separate the time spent fetching and parsing streamed items
+        from the time spent processing them.
+        """
+        if (not self.enabled):
+            return iterable
+        return self._iterate(name, iterable)
+
+    def _iterate(self, name, iterable):
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    value = next(it)
+                except StopIteration:
+                    return
+            yield value
+
+    def summary(self):
+        """Dict of stages and counters suitable for JSON output."""
+        return {'stages': self.stages, 'counters': self.counters}
+
+
+PROFILE = Profile()
+
+
+# Options for convert_html_to_tex(), part of the TexCache key so bump
+# version if the conversion changes
+TEX_OPTIONS = {'body_width': 0, 'version': 1}
+
+# Reused html2text converters for convert_html_to_tex()
+HTML2TEXT_POOL = html2text.HTML2TextPool(body_width=TEX_OPTIONS['body_width'])  # no wrapping
+
+
+def convert_html_to_tex(html):
     """Simple wrapper for html2txt with some options and tweak to make TeX."""
-    h = html2text.HTML2Text()
-    h.body_width = 0  # no wrapping
-    txt = h.handle(html).strip()
+    PROFILE.count('HTML bytes converted', len(html))
+    with HTML2TEXT_POOL.converter() as h:
+        txt = h.handle(html).strip()
     # Remove linebreaks
     txt = re.sub(r'[\r\n]', ' ', txt)
     # Deal with some TeX issues
@@ -50,6 +247,182 @@ def html_to_tex(html):
     return txt
 
 
+class TexCache(object):
+    """Results of convert_html_to_tex() for each HTML string.
+
+    Recently used results are kept in memory, up to size of them (0 to
+    disable the cache). If load() is called then results are also looked
+    up in an SQLite database, keyed by a hash of TEX_OPTIONS and the HTML.
+    Only the rows asked for are read, and new results are written in
+    batches of batch, so memory use is bounded by size whatever the size of
+    the database. save() drops the results not used for max_age seconds
+    so that those for issues no longer reported don't persist, while
+    reports with different queries can share the database.
+    """
+
+    def __init__(self, size=10000, batch=1000, max_age=CACHE_MAX_AGE):
+        self.size = size
+        self.batch = batch
+        self.max_age = max_age
+        self.memory = OrderedDict()
+        self.path = None
+        self.db = None
+        self.pending = {}  # key -> tex not yet written to db
+        self.used = set()  # keys of results read from db
+        self.prefix = json.dumps(TEX_OPTIONS, sort_keys=True)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, html):
+        """Key for html in the on-disk tier."""
+        return hashlib.sha1((self.prefix + html).encode('utf-8')).hexdigest()
+
+    def load(self, path):
+        """Use SQLite database at path as on-disk tier, ignore it if bad."""
+        self.path = path
+        try:
+            self.db = sqlite3.connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS results "
+                            "(key TEXT PRIMARY KEY, tex TEXT NOT NULL, used REAL NOT NULL)")
+        except sqlite3.Error as e:
+            logging.warn("Ignoring bad TeX cache %s: %s" % (path, str(e)))
+            self.db = None
+
+    def flush(self):
+        """Write pending results to the on-disk tier."""
+        if (self.pending):
+            with self.db:
+                now = time.time()
+                self.db.executemany("INSERT OR REPLACE INTO results (key, tex, used) VALUES (?, ?, ?)",
+                                    ((key, tex, now) for (key, tex) in self.pending.items()))
+            self.pending.clear()
+
+    def save(self):
+        """Write results of this run to the on-disk tier, drop those not used for max_age.
+
+        Each write is an SQLite transaction so runs sharing a cache dir
+        don't overwrite each other's results.
+        """
+        if (self.db is None):
+            return
+        self.flush()
+        with self.db:
+            now = time.time()
+            self.db.executemany("UPDATE results SET used = ? WHERE key = ?",
+                                ((now, key) for key in self.used))
+            self.db.execute("DELETE FROM results WHERE used < ?", (now - self.max_age,))
+        self.db.close()
+        self.db = None
+
+    def lookup(self, html):
+        """TeX for html if in the cache, else None."""
+        tex = self.memory.get(html)
+        if (tex is not None):
+            self.memory.move_to_end(html)
+            self.hits += 1
+            return tex
+        if (self.db is not None):
+            key = self.key(html)
+            tex = self.pending.get(key)
+            if (tex is None):
+                row = self.db.execute("SELECT tex FROM results WHERE key = ?", (key,)).fetchone()
+                if (row is not None):
+                    tex = row[0]
+                    self.used.add(key)
+            if (tex is not None):
+                self.disk_hits += 1
+                self.remember(html, tex)
+        return tex
+
+    def remember(self, html, tex):
+        """Add tex for html to the in-memory tier."""
+        self.memory[html] = tex
+        if (len(self.memory) > self.size):
+            self.memory.popitem(last=False)
+
+    def store(self, html, tex):
+        """Add newly converted tex for html to the cache."""
+        if (self.db is not None):
+            self.pending[self.key(html)] = tex
+            if (len(self.pending) >= self.batch):
+                self.flush()
+        self.remember(html, tex)
+
+    def get(self, html, convert):
+        """TeX for html from the cache, else from convert(html)."""
+        if (self.size <= 0):
+            return convert(html)
+        tex = self.lookup(html)
+        if (tex is None):
+            self.misses += 1
+            tex = convert(html)
+            self.store(html, tex)
+        return tex
+
+    def get_many(self, htmls, convert_many):
+        """List of TeX for each of htmls, as get() but with one call of
+        convert_many(list of html) for all those not in the cache."""
+        if (self.size <= 0):
+            return convert_many(htmls)
+        texs = [None] * len(htmls)
+        missing = OrderedDict()  # html -> indexes in htmls
+        for (n, html) in enumerate(htmls):
+            tex = self.lookup(html)
+            if (tex is None):
+                missing.setdefault(html, []).append(n)
+            else:
+                texs[n] = tex
+        if (missing):
+            self.misses += len(missing)
+            for (html, tex) in zip(missing, convert_many(list(missing))):
+                self.store(html, tex)
+                for n in missing[html]:
+                    texs[n] = tex
+        return texs
+
+    def summary(self):
+        """One line summary of the hit rate."""
+        total = self.hits + self.disk_hits + self.misses
+        return("TeX conversion cache: %d lookups, %d memory hits, %d disk hits, %d converted (%.1f%% hit rate)" % (
+            total, self.hits, self.disk_hits, self.misses,
+            100.0 * (self.hits + self.disk_hits) / total if total else 0.0))
+
+
+TEX_CACHE = TexCache()
+
+
+def html_to_tex(html):
+    """TeX for html, see convert_html_to_tex(), using TEX_CACHE."""
+    return TEX_CACHE.get(html, convert_html_to_tex)
+
+
+def convert_html_batch(htmls, workers=1, chunk_size=64):
+    """List of convert_html_to_tex() for each of htmls, in order.
+
+    If workers > 1 and there is more than one chunk of chunk_size strings
+    then they are converted by a pool of workers, each given a chunk at a
+    time. The html2text converters are thread safe so the pool is of
+    threads when running without the GIL (free-threaded Python), else of
+    processes.
+    """
+    if (workers <= 1 or len(htmls) <= chunk_size):
+        return [convert_html_to_tex(html) for html in htmls]
+    if (not getattr(sys, '_is_gil_enabled', lambda: True)()):
+        chunks = [htmls[n:n + chunk_size] for n in range(0, len(htmls), chunk_size)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return [tex for texs in executor.map(convert_html_chunk, chunks) for tex in texs]
+    PROFILE.count('HTML bytes converted', sum(len(html) for html in htmls))
+    # stop tracing memory in forked workers, it would just slow them
+    with ProcessPoolExecutor(max_workers=workers, initializer=tracemalloc.stop) as executor:
+        return list(executor.map(convert_html_to_tex, htmls, chunksize=chunk_size))
+
+
+def convert_html_chunk(htmls):
+    """List of convert_html_to_tex() for each of htmls."""
+    return [convert_html_to_tex(html) for html in htmls]
+
+
 def issue_number(issue):
     """Return issue number extracted from issue['key']."""
     m = re.match(r'[A-Z]+\-(\d+)', issue['key'])
@@ -62,45 +435,503 @@ def key_number(key):
     return(int(m.group(1)) if (m) else 0)
 
 
-def jira_login_cookie(baseuri, username='', password=''):
-    """Jira login to get cookie.
+class PooledResponse(object):
+    """HTTP response that returns its connection to the pool when closed."""
+
+    def __init__(self, session, pool_key, conn, response):
+        self.session = session
+        self.pool_key = pool_key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+
+    def read(self, size=None):
+        if (size is not None and size < 0):
+            size = None
+        return self.response.read(size)
 
-    See docs at: https://developer.atlassian.com/jiradev/jira-apis/jira-rest-apis/jira-rest-api-tutorials/jira-rest-api-example-cookie-based-authentication
+    def close(self):
+        if (self.conn is None):
+            return
+        # a partly read response is not drained, that could mean downloading
+        # the rest of a large page, instead the connection is not reused
+        self.session.release_connection(self.pool_key, self.conn,
+                                        self.response.will_close or not self.response.isclosed())
+        self.conn = None
 
-    Can test loging from command line with
+    def __enter__(self):
+        return self
 
-    curl -v -H "Content-type: application/json" --data '{ "username": "XXX", "password": "YYY" }' https://culibrary.atlassian.net/rest/auth/1/session
+    def __exit__(self, *args):
+        self.close()
 
-    expect HTTP 200 and JSON content with:
 
-    {"session":{"name":"cloud.session.token","value":"eyJraWQ..."}}
+class JiraSession(object):
+    """Jira login session using a pool of keep-alive connections.
 
-    where we return the cookie "cloud.session.token=eyJraWQ..."
+    The session cookie is obtained lazily on the first request that needs
+    it and saved, along with its expiry, in cookie_file (if given) so that
+    later runs can skip the login. A new login is done only if Jira responds
+    401 Unauthorized. All requests, including the login, share a pool of
+    persistent HTTP connections so that only the first request to a host
+    pays for the connection and TLS handshake. The session may be used
+    from several threads.
+
+    As with urlopen(), proxies are taken from the environment (http_proxy,
+    https_proxy and no_proxy), HTTPS being tunnelled with CONNECT, and
+    redirects are followed for GET requests.
     """
-    if (username is None or username == ''):
-        logging.warn("No jira username supplied, will not try to login.")
-        return()
-    if (password is None or password == ''):
-        password = getpass.getpass("No jira password supplied, enter now:")
 
-    auth_uri = urljoin(baseuri, 'rest/auth/1/session')
-    logging.warn("Trying Jira login for %s at %s..." % (username, auth_uri))
-    auth_data = json.dumps({'username': username, 'password': password}).encode()
-    req = Request(auth_uri, auth_data, headers={'Content-type': 'application/json'})
-    with urlopen(req) as fh:
-        data = json.loads(fh.read().decode())
+    default_lifetime = 3600  # seconds, if Jira doesn't say when cookie expires
+    max_redirects = 10
+
+    def __init__(self, baseuri, username='', password='', cookie_file=None):
+        self.baseuri = baseuri
+        self.username = username
+        self.password = password
+        self.cookie_file = cookie_file
+        self.cookie = None
+        self.expires = 0
+        self.lock = threading.Lock()  # protects pools
+        self.login_lock = threading.Lock()
+        self.pools = {}
+        self.proxies = getproxies()
+        self.warned_anonymous = False
+        self.load_cookie()
+
+    def load_cookie(self):
+        """Load unexpired cookie for this baseuri and username from cookie_file."""
+        if (not self.cookie_file or not os.path.exists(self.cookie_file)):
+            return
+        try:
+            with open(self.cookie_file) as fh:
+                data = json.load(fh)
+            if (data.get('baseuri') == self.baseuri and
+                    data.get('username') == self.username and
+                    data.get('expires', 0) > time.time()):
+                (self.cookie, self.expires) = (data['cookie'], data['expires'])
+                logging.debug("Reusing Jira login cookie from %s" % (self.cookie_file))
+        except (ValueError, OSError, KeyError, AttributeError) as e:
+            logging.warn("Ignoring bad Jira login cookie file %s: %s" % (self.cookie_file, str(e)))
+            (self.cookie, self.expires) = (None, 0)
+
+    def save_cookie(self):
+        """Save cookie to cookie_file, readable only by the user."""
+        if (not self.cookie_file):
+            return
+        data = {'baseuri': self.baseuri,
+                'username': self.username,
+                'cookie': self.cookie,
+                'expires': self.expires}
+        tmp_path = '%s.%d.tmp' % (self.cookie_file, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # mode is only used if the file is created
+        os.chmod(tmp_path, 0o600)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(data, fh)
+        os.replace(tmp_path, self.cookie_file)
+
+    def proxy(self, pool_key):
+        """(netloc, headers) of the proxy for (scheme, netloc) pool_key, else None.
+
+        headers has Proxy-Authorization if the proxy URI includes a username.
+        """
+        (scheme, netloc) = pool_key
+        proxy_uri = self.proxies.get(scheme)
+        if (not proxy_uri or proxy_bypass(urlsplit('//' + netloc).hostname)):
+            return None
+        if ('://' not in proxy_uri):
+            proxy_uri = 'http://' + proxy_uri
+        parts = urlsplit(proxy_uri)
+        headers = {}
+        if (parts.username is not None):
+            credentials = '%s:%s' % (unquote(parts.username), unquote(parts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+        return (parts.netloc.rpartition('@')[2], headers)
+
+    def get_connection(self, pool_key):
+        """Get an idle connection for (scheme, netloc) pool_key, or a new one."""
+        with self.lock:
+            pool = self.pools.setdefault(pool_key, [])
+            if (pool):
+                return pool.pop()
+        (scheme, netloc) = pool_key
+        proxy = self.proxy(pool_key)
+        if (scheme == 'https'):
+            if (proxy):
+                conn = http.client.HTTPSConnection(proxy[0])
+                conn.set_tunnel(netloc, headers=proxy[1])
+                return conn
+            return http.client.HTTPSConnection(netloc)
+        return http.client.HTTPConnection(proxy[0] if proxy else netloc)
+
+    def release_connection(self, pool_key, conn, will_close=False):
+        """Return conn to the pool unless it is to be closed (will_close)."""
+        if (will_close):
+            conn.close()
+            return
+        with self.lock:
+            self.pools.setdefault(pool_key, []).append(conn)
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            for pool in self.pools.values():
+                for conn in pool:
+                    conn.close()
+            self.pools = {}
+
+    def request(self, uri, data=None, headers=None):
+        """Make one request on a pooled connection, return PooledResponse.
+
+        A request on an idle connection the server has since dropped is
+        retried once on a new connection.
+        """
+        parts = urlsplit(uri)
+        pool_key = (parts.scheme, parts.netloc)
+        path = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        headers = dict(headers or {})
+        proxy = self.proxy(pool_key)
+        if (proxy and parts.scheme == 'http'):
+            # plain HTTP proxy is sent the full URI
+            path = urlunsplit((parts.scheme, parts.netloc, parts.path or '/', parts.query, ''))
+            headers.update(proxy[1])
+        method = 'GET' if data is None else 'POST'
+        for attempt in (1, 2):
+            conn = self.get_connection(pool_key)
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError) as e:
+                conn.close()
+                if (attempt == 2):
+                    raise
+                logging.debug("Retrying %s on new connection (%s)" % (uri, str(e)))
+                continue
+            return PooledResponse(self, pool_key, conn, response)
+
+    def login(self):
+        """Jira login to get cookie.
+
+        See docs at: https://developer.atlassian.com/jiradev/jira-apis/jira-rest-apis/jira-rest-api-tutorials/jira-rest-api-example-cookie-based-authentication
+
+        Can test loging from command line with
+
+        curl -v -H "Content-type: application/json" --data '{ "username": "XXX", "password": "YYY" }' https://culibrary.atlassian.net/rest/auth/1/session
+
+        expect HTTP 200 and JSON content with:
+
+        {"session":{"name":"cloud.session.token","value":"eyJraWQ..."}}
+
+        where we set the cookie "cloud.session.token=eyJraWQ...". The expiry is
+        taken from the Set-Cookie header if present.
+        """
+        if (self.password is None or self.password == ''):
+            self.password = getpass.getpass("No jira password supplied, enter now:")
+
+        auth_uri = urljoin(self.baseuri, 'rest/auth/1/session')
+        logging.warn("Trying Jira login for %s at %s..." % (self.username, auth_uri))
+        auth_data = json.dumps({'username': self.username, 'password': self.password}).encode()
+        with self.request(auth_uri, auth_data, headers={'Content-type': 'application/json'}) as fh:
+            if (fh.status != 200):
+                raise Exception("Jira cookie login failed with HTTP status %d" % (fh.status))
+            set_cookie = fh.response.getheader('Set-Cookie')
+            data = json.loads(fh.read().decode())
         if ('session' in data and
                 'name' in data['session'] and
                 'value' in data['session'] and
                 data['session']['name'] == 'cloud.session.token'):
-            cookie = data['session']['name'] + '=' + data['session']['value']
+            self.cookie = data['session']['name'] + '=' + data['session']['value']
+            self.expires = cookie_expiry(set_cookie, data['session']['name'],
+                                         time.time() + self.default_lifetime)
+            self.save_cookie()
             logging.warn("Got Jira login cookie.")
-            return(cookie)
+            return
         raise Exception("Unexpected response from Jira cookie login")
 
+    def open(self, uri):
+        """GET uri with session cookie, logging in first if necessary.
+
+        Returns a PooledResponse which must be closed. If there is no
+        username then no login is attempted and the request is anonymous.
+        Redirects are followed, up to max_redirects.
+        """
+        for redirect in range(self.max_redirects + 1):
+            fh = self.open_once(uri)
+            location = fh.response.getheader('Location')
+            if (fh.status not in (301, 302, 303, 307, 308) or not location):
+                break
+            fh.close()
+            logging.debug("Redirected from %s to %s" % (uri, location))
+            uri = urljoin(uri, location)
+        if (fh.status != 200):
+            fh.close()
+            raise HTTPError(uri, fh.status, fh.response.reason, fh.response.headers, None)
+        return fh
+
+    def open_once(self, uri):
+        """GET uri with session cookie, as open() but without following redirects."""
+        cookie = None
+        if (self.username is None or self.username == ''):
+            if (not self.warned_anonymous):
+                logging.warn("No jira username supplied, will not try to login.")
+                self.warned_anonymous = True
+        else:
+            with self.login_lock:
+                if (self.cookie is None or self.expires <= time.time()):
+                    self.login()
+                cookie = self.cookie
+        fh = self.request(uri, headers={'Cookie': cookie} if cookie else {})
+        if (fh.status == 401 and cookie):
+            fh.close()
+            with self.login_lock:
+                if (self.cookie == cookie):
+                    logging.warn("Jira login cookie rejected, logging in again")
+                    self.login()
+                cookie = self.cookie
+            fh = self.request(uri, headers={'Cookie': cookie})
+        return fh
+
+
+def cookie_expiry(set_cookie, name, default):
+    """Expiry time of cookie name from Set-Cookie header value, else default."""
+    if (not set_cookie):
+        return default
+    cookies = SimpleCookie()
+    try:
+        cookies.load(set_cookie)
+    except CookieError:
+        return default
+    if (name not in cookies):
+        return default
+    morsel = cookies[name]
+    if (morsel['max-age']):
+        return time.time() + int(morsel['max-age'])
+    if (morsel['expires']):
+        return parsedate_to_datetime(morsel['expires']).timestamp()
+    return default
+
+
+def jira_search_uri(baseuri, query, fields, start=0, page_size=1000):
+    """URI for one page of the XML search results.
+
+    The page is selected with the tempMax (page size) and pager/start (offset)
+    parameters of the Jira issue view.
+    """
+    params = [('jql', query), ('tempMax', page_size)]
+    if (start > 0):
+        params.append(('pager/start', start))
+    for field in fields:
+        params.append(('field', field))
+    return urljoin(baseuri,
+                   'sr/jira.issueviews:searchrequest-xml/temp/SearchRequest.xml?' + urlencode(params))
+
 
-def query_jira(baseuri, query, username, password, fields=None, options=None):
-    """Run query against Jira.
+class CacheWriter(object):
+    """Wrap a response file handle to copy everything read into a cache file.
+
+    The data is written to a temporary file which is moved into place on
+    close() only if the whole response was read, so an interrupted read
+    never leaves a partial cache entry.
+    """
+
+    def __init__(self, fh, path):
+        self.fh = fh
+        self.path = path
+        self.tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        self.tmp = open(self.tmp_path, 'wb')
+        self.complete = False
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        self.tmp.write(data)
+        if (not data or size is None or size < 0):
+            self.complete = True
+        return data
+
+    def close(self):
+        self.fh.close()
+        self.tmp.close()
+        if (self.complete):
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResponseCache(object):
+    """On-disk cache of raw Jira responses.
+
+    Entries are keyed by a hash of the request URI, which includes the
+    baseuri, JQL, field list and page. A cached response is reused if it is
+    younger than ttl seconds, or whatever its age if offline is set, in which
+    case a missing entry is an error rather than a reason to go to the
+    network. Every response fetched is stored for later use. Entries older
+    than max_age (or ttl if longer) are removed when the cache is opened,
+    unless offline, so that those for past incremental and linked issue
+    queries don't accumulate. This isn't done at ttl as the entries are
+    still wanted for --offline.
+
+    A 400 Bad Request, which Jira gives for a query naming keys that don't
+    exist, is also stored (as an .error file with the status and reason)
+    and raised again in the same way, so fetch_issues_by_key() splits the
+    same batches offline as it did online.
+    """
+
+    CACHED_ERRORS = (400,)
+
+    def __init__(self, cache_dir, ttl=0, offline=False, max_age=CACHE_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
+        self.max_age = max(ttl, max_age)
+        os.makedirs(cache_dir, exist_ok=True)
+        if (not offline):
+            self.evict()
+
+    def evict(self):
+        """Remove entries, and any temporary files left, older than max_age."""
+        cutoff = time.time() - self.max_age
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            if (not name.endswith(('.response', '.error', '.tmp'))):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if (os.path.getmtime(path) < cutoff):
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass  # removed by another run
+        PROFILE.count('cached responses removed', removed)
+
+    def path(self, uri, suffix='.response'):
+        """Cache file path for uri."""
+        return os.path.join(self.cache_dir, hashlib.sha256(uri.encode('utf-8')).hexdigest() + suffix)
+
+    def usable(self, path):
+        """Age in seconds of cache file path if it may be used, else None."""
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            return(None)
+        if (self.offline or age < self.ttl):
+            return(age)
+        return(None)
+
+    def open(self, uri, fetch):
+        """Open cached response for uri, else call fetch() and cache that."""
+        path = self.path(uri)
+        error_path = self.path(uri, '.error')
+        age = self.usable(path)
+        if (age is not None):
+            logging.debug("Using cached response %s (%ds old)" % (path, age))
+            return open(path, 'rb')
+        age = self.usable(error_path)
+        if (age is not None):
+            logging.debug("Using cached error %s (%ds old)" % (error_path, age))
+            with open(error_path) as fh:
+                (code, reason) = fh.read().split(' ', 1)
+            raise HTTPError(uri, int(code), reason, None, None)
+        if (self.offline):
+            raise Exception("No cached response for %s, cannot run offline" % (uri))
+        try:
+            fh = fetch()
+        except HTTPError as e:
+            if (e.code in self.CACHED_ERRORS):
+                self.save_error(error_path, e)
+                if (os.path.exists(path)):
+                    os.remove(path)
+            raise
+        return CacheWriter(fh, path)
+
+    def save_error(self, error_path, e):
+        """Store status and reason of HTTPError e in error_path."""
+        tmp_path = '%s.%d.tmp' % (error_path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            fh.write('%d %s' % (e.code, e.reason))
+        os.replace(tmp_path, error_path)
+
+
+def open_jira_search(session, query_uri, cache=None):
+    """Open one XML search response, returns a binary file handle.
+
+    If cache is given then the response may come from, and will be stored
+    in, that ResponseCache. Otherwise it is fetched using the JiraSession.
+    """
+    def fetch():
+        return session.open(query_uri)
+    if (cache is None):
+        return fetch()
+    return cache.open(query_uri, fetch)
+
+
+def iter_jira_items(fh, info=None, clear=True):
+    """Yield each channel/item element as it is parsed from XML in fh.
+
+    The response is parsed incrementally with iterparse so that parsing overlaps
+    with reading from the network and only the current item is held in memory.
+    Each item is removed from the tree once the consumer has finished with
+    it and, unless clear is False, also cleared so must not be kept.
+
+    If info is a dict then info['total'] is set from the channel element
+    <issue start="0" end="50" total="1234"/> if present, and info['page_size']
+    to the number of items in this response (end - start). This appears
+    before the items.
+    """
+    depth = 0
+    channel = None
+    for event, el in ElementTree.iterparse(fh, events=('start', 'end')):
+        if (event == 'start'):
+            depth += 1
+            if (depth == 2 and el.tag == 'channel'):
+                channel = el
+            continue
+        depth -= 1
+        if (depth != 2 or channel is None):
+            continue
+        if (el.tag == 'item'):
+            yield el
+            if (clear):
+                el.clear()
+            channel.remove(el)
+        elif (el.tag == 'issue' and info is not None and 'total' in el.attrib):
+            info['total'] = int(el.attrib['total'])
+            if ('start' in el.attrib and 'end' in el.attrib):
+                info['page_size'] = int(el.attrib['end']) - int(el.attrib['start'])
+
+
+def fetch_jira_items(session, query_uri, cache=None, info=None):
+    """Fetch one page of XML search results and return list of items."""
+    with open_jira_search(session, query_uri, cache) as fh:
+        return list(iter_jira_items(fh, info, clear=False))
+
+
+def show_jira_xml(session, query, fields, page_size, cache=None):
+    """Print the XML response for each page of results."""
+    start = 0
+    total = 1
+    while (start < total):
+        query_uri = jira_search_uri(session.baseuri, query, fields, start, page_size)
+        with open_jira_search(session, query_uri, cache) as fh:
+            xml = fh.read().decode("utf-8")
+        print(xml)
+        el = ElementTree.fromstring(xml).find('./channel/issue')
+        if (el is None or 'total' not in el.attrib):
+            break
+        total = int(el.attrib['total'])
+        if (start == 0 and int(el.attrib.get('end', 0)) > 0):
+            page_size = int(el.attrib['end'])  # Jira may cap the page size
+        start += page_size
+
+
+def query_jira(session, query, fields=None, options=None, cache=None):
+    """Run query against Jira, yield each item element of the results.
 
     Extract from Jira 5.2.5 XML response:
 
@@ -110,25 +941,470 @@ def query_jira(baseuri, query, username, password, fields=None, options=None):
     the URL of your request.
     For example:
     https://issues.library.cornell.edu/sr/jira.issueviews:searchrequest-xml/temp/SearchRequest.xml?jqlQuery=project+%3D+ARXIVDEV+AND+resolution+%3D+Unresolved+AND+fixVersion+%3D+%22Roadmap+%28Epics%29%22+ORDER+BY+priority+DESC&tempMax=1000&field=key&field=summary
+
+    Jira caps the number of issues in one response so the results are
+    fetched in pages of options.page_size issues. The first page is parsed
+    as it is received and tells us the total and the actual page size,
+    which is smaller if Jira caps it (jira.search.views.default.max). As
+    soon as those are known the remaining pages are fetched concurrently
+    using up to options.threads threads, with at most that many pages held
+    waiting. Items are yielded in order. An exception is raised if the
+    number of items received does not match the total.
+
+    Items are cleared after use, see iter_jira_items(). Responses are read
+    from and written to cache if given. The JiraSession only logs in when
+    a response is actually needed from Jira.
     """
-    cookie = jira_login_cookie(baseuri, username, password)
+    baseuri = session.baseuri
+    page_size = options.page_size
+
+    query_uri = jira_search_uri(baseuri, query, fields, 0, page_size)
+    if (options.show_uri):
+        print(query_uri)
+        sys.exit(0)
+    if (options.show_xml):
+        show_jira_xml(session, query, fields, page_size, cache)
+        sys.exit(0)
+
+    info = {}
+    uris = None
+    futures = deque()
+
+    def submit_pages():
+        while (uris and len(futures) < options.threads):
+            futures.append(executor.submit(fetch_jira_items, session, uris.popleft(), cache))
+
+    with ThreadPoolExecutor(max_workers=options.threads) as executor:
+        num_items = 0
+        with open_jira_search(session, query_uri, cache) as fh:
+            for item in iter_jira_items(fh, info):
+                if (uris is None and 'total' in info):
+                    if (info.get('page_size', 0) > 0):
+                        page_size = info['page_size']
+                    uris = deque(jira_search_uri(baseuri, query, fields, start, page_size)
+                                 for start in range(page_size, info['total'], page_size))
+                    if (uris):
+                        logging.warn("Fetching %d issues in pages of %d..." % (info['total'], page_size))
+                    submit_pages()
+                num_items += 1
+                yield item
+        if ('total' not in info):
+            # Don't know how many to expect, keep going until we get a page
+            # shorter than the first (which may be short if Jira caps it)
+            page_size = num_items
+            start = num_items
+            while (num_items == page_size and num_items > 0):
+                items = fetch_jira_items(session, jira_search_uri(baseuri, query, fields, start, page_size), cache)
+                num_items = len(items)
+                start += num_items
+                for item in items:
+                    yield item
+            return
+        received = num_items
+        while (futures):
+            items = futures.popleft().result()
+            submit_pages()
+            received += len(items)
+            for item in items:
+                yield item
+    if (received != info['total']):
+        raise Exception("Received %d issues but Jira reported %d matching the query" %
+                        (received, info['total']))
+
+
+# Names of fields in the JSON REST API for fields of the XML issue view,
+# None where there is no corresponding JSON field to request
+JSON_FIELDS = {
+    'key': None,
+    'link': None,
+    'type': 'issuetype',
+    'summary': 'summary',
+    'description': 'description',
+    'status': 'status',
+    'component': 'components',
+    'priority': 'priority',
+    'issuelinks': 'issuelinks',
+    'timetracking': 'timeestimate',
+}
+
+
+def jira_json_search_uri(baseuri, query, fields, start=0, page_size=1000):
+    """URI for one page of the JSON REST API search results.
 
-    params = [('jql', query), ('tempMax', 1000)]
+    Only the JSON fields that correspond to the XML view fields are
+    requested, and descriptions are requested as rendered HTML to match the
+    XML view. Custom field ids such as customfield_10730 are passed through.
+    If none of fields has a JSON field (e.g. just key) then issuetype is
+    requested, as Jira gives all fields for an empty list.
+    """
+    json_fields = []
     for field in fields:
-        params.append(('field', field))
-    query_uri = urljoin(baseuri,
-                        'sr/jira.issueviews:searchrequest-xml/temp/SearchRequest.xml?' + urlencode(params))
+        json_field = JSON_FIELDS.get(field, field)
+        if (json_field is not None and json_field not in json_fields):
+            json_fields.append(json_field)
+    if (not json_fields):
+        json_fields.append('issuetype')
+    params = [('jql', query),
+              ('startAt', start),
+              ('maxResults', page_size),
+              ('fields', ','.join(json_fields)),
+              ('expand', 'renderedFields')]
+    return urljoin(baseuri, 'rest/api/2/search?' + urlencode(params))
+
+
+def parse_json_links(key, issuelinks):
+    """Parse issuelinks from the JSON API into a dict as parse_issue_links() does.
+
+    Key is just used for debugging information.
+    """
+    links = {}
+    for link in issuelinks or []:
+        if ('outwardIssue' in link):
+            (linktype, target) = (link['type']['outward'], link['outwardIssue'])
+            direction = 'outward'
+        else:
+            (linktype, target) = (link['type']['inward'], link['inwardIssue'])
+            direction = 'inward'
+        if (linktype in relation_translations):
+            linktype = relation_translations[linktype]
+        else:
+            logging.warn("%s: Unexpected %s link type: '%s'" % (key, direction, linktype))
+        links.setdefault(linktype, []).append(target['key'])
+        PROFILE.count('links parsed')
+    return(links)
+
+
+def json_value(value):
+    """Text of a JSON API field value, the value or name of an option, None if no value."""
+    if (isinstance(value, dict)):
+        value = value.get('value', value.get('name'))
+    return(None if value is None else str(value))
+
+
+def json_issue_to_issue(issue, fields, epic_link_field=EPIC_LINK_FIELD):
+    """Issue from JSON API issue data, with the fields split_jira_results()
+    sets from an item of the XML view.
+
+    Fields that the issue doesn't have are set to a placeholder as by
+    set_text_field(). The time estimate is in seconds so days are
+    calculated from that with Jira's default of 8 hour days.
+    """
+    data = issue.get('fields', {})
+    rendered = issue.get('renderedFields') or {}
+    key = issue['key']
+    values = {'key': key}
+    if (issue.get('link')):
+        values['link'] = issue['link']
+    for (field, json_field) in (('type', 'issuetype'), ('status', 'status'), ('priority', 'priority')):
+        if (data.get(json_field)):
+            values[field] = data[json_field]['name']
+    if ('summary' in data):
+        values['summary'] = data['summary']
+    if ('description' in data):
+        values['description'] = rendered.get('description') or data['description']
+    if (data.get('updated')):
+        values['updated'] = data['updated']
+    if (data.get('components')):
+        values['component'] = data['components'][0]['name']
+    args = Issue()
+    for field in (['key'] + fields + ['timeestimate']):
+        if (field == epic_link_field):
+            continue
+        elif (field == 'issuelinks'):
+            args['issuelinks'] = parse_json_links(key, data.get('issuelinks'))
+            args['parsed_links'] = dict(args['issuelinks'])
+        elif (field == 'timeestimate' and data.get('timeestimate') is not None):
+            args['days'] = data['timeestimate'] / (8.0 * 60.0 * 60.0)
+        elif (field.startswith('customfield_') and data.get(field) is not None):
+            args[field] = json_value(data[field])
+        elif (field in values):
+            args[field] = values[field]
+        else:
+            set_text_field(args, key, field, None)
+    args['epic'] = json_value(data.get(epic_link_field)) or ''
+    return(args)
+
+
+def fetch_jira_json(session, query_uri, cache=None):
+    """Fetch one page of JSON search results, return (issues, total, page_size).
+
+    The link to each issue is added as link, as it is not in the JSON data.
+    """
+    with open_jira_search(session, query_uri, cache) as fh:
+        data = json.loads(fh.read().decode('utf-8'))
+    issues = data['issues']
+    for issue in issues:
+        issue['link'] = urljoin(session.baseuri, 'browse/' + issue['key'])
+    return(issues, data['total'], data['maxResults'])
+
+
+def query_jira_json(session, query, fields=None, options=None, cache=None):
+    """Run query using the JSON REST API, yield the data for each issue.
+
+    This is an alternative to the XML issue view used by query_jira() which
+    requests only the fields needed (see jira_json_search_uri()) and so gives
+    smaller responses. The issues are dicts as decoded from the JSON, which
+    split_jira_results() takes as well as item elements. As for query_jira(),
+    results are fetched in pages with up to options.threads pages fetched
+    concurrently. Jira may return fewer issues per page than
+    options.page_size, the page size it reports in the first response is
+    used for the rest. An exception is raised if the number of issues
+    received is not the total Jira reported.
+    """
+    baseuri = session.baseuri
+    query_uri = jira_json_search_uri(baseuri, query, fields, 0, options.page_size)
     if (options.show_uri):
         print(query_uri)
         sys.exit(0)
-    req = Request(query_uri, headers={'Cookie': cookie})
-    with urlopen(req) as fh:
-        xml = fh.read().decode("utf-8")
-        if (options.show_xml):
-            print(xml)
-            sys.exit(0)
-        # return parsed etree root element
-        return ElementTree.fromstring(xml)  # FIXME - would be better to parse fh but need to decode
+    (issues, total, page_size) = fetch_jira_json(session, query_uri, cache)
+    if (options.show_xml):
+        print(json.dumps(issues, indent=2))
+        sys.exit(0)
+    for issue in issues:
+        yield issue
+    received = len(issues)
+    if (page_size >= 1 and received < total):
+        logging.warn("Fetching %d issues in pages of %d..." % (total, page_size))
+        uris = deque(jira_json_search_uri(baseuri, query, fields, start, page_size)
+                     for start in range(received, total, page_size))
+        futures = deque()
+        with ThreadPoolExecutor(max_workers=options.threads) as executor:
+            while (uris or futures):
+                while (uris and len(futures) < options.threads):
+                    futures.append(executor.submit(fetch_jira_json, session, uris.popleft(), cache))
+                issues = futures.popleft().result()[0]
+                received += len(issues)
+                for issue in issues:
+                    yield issue
+    if (received != total):
+        raise Exception("Received %d issues but Jira reported %d matching the query" %
+                        (received, total))
+
+
+def search_jira(session, query, fields=None, options=None, cache=None):
+    """Run query using the backend selected by options.backend, yield items.
+
+    Items are elements from the XML view or dicts from the JSON API, see
+    item_key().
+    """
+    if (options.backend == 'json'):
+        return query_jira_json(session, query, fields, options, cache)
+    return query_jira(session, query, fields, options, cache)
+
+
+def split_jql_order_by(query):
+    """Split JQL query into (filter, order_by) where order_by may be ''."""
+    m = re.match(r'(.*?)\s+(ORDER\s+BY\s+.*)$', query, flags=re.IGNORECASE | re.DOTALL)
+    if (m):
+        return(m.group(1), m.group(2))
+    return(query, '')
+
+
+def item_key(item):
+    """Key of item, an element from the XML view or a dict from the JSON API."""
+    if (isinstance(item, dict)):
+        return(item['key'])
+    return(item.find('key').text)
+
+
+def item_updated(item):
+    """Updated date text of item as given by Jira, None if not known."""
+    if (isinstance(item, dict)):
+        return(item.get('fields', {}).get('updated'))
+    return(item.findtext('updated'))
+
+
+def load_sync_state(state_path):
+    """Load (mark, items) from incremental sync state file.
+
+    The state file is an XML document in the same form as the Jira
+    response, with the high-water mark as an attribute of the channel, or
+    for the JSON backend a JSON object with the mark and the list of
+    issues. Items are returned as an ordered dict by key. Returns
+    (None, {}) if there is no state file.
+    """
+    if (not os.path.exists(state_path)):
+        return(None, OrderedDict())
+    with open(state_path, 'rb') as fh:
+        is_json = (fh.read(1) == b'{')
+    if (is_json):
+        with open(state_path, 'r') as fh:
+            data = json.load(fh)
+        return(data.get('mark'), OrderedDict((issue['key'], issue) for issue in data['issues']))
+    channel = ElementTree.parse(state_path).getroot().find('./channel')
+    items = OrderedDict()
+    for item in channel.findall('./item'):
+        items[item.find('key').text] = item
+    return(channel.attrib.get('mark'), items)
+
+
+def save_sync_state(state_path, mark, items):
+    """Write mark and items to incremental sync state file, as JSON if items are from the JSON API."""
+    tmp_path = '%s.%d.tmp' % (state_path, os.getpid())
+    if (any(isinstance(item, dict) for item in items.values())):
+        with open(tmp_path, 'w') as fh:
+            json.dump({'mark': mark, 'issues': list(items.values())}, fh)
+    else:
+        root = ElementTree.Element('rss')
+        channel = ElementTree.SubElement(root, 'channel', {'mark': mark} if (mark) else {})
+        channel.extend(items.values())
+        ElementTree.ElementTree(root).write(tmp_path, encoding='utf-8', xml_declaration=True)
+    os.replace(tmp_path, state_path)
+
+
+def parse_jira_datetime(text):
+    """Timezone aware datetime from Jira date text.
+
+    The XML view gives dates like "Mon, 2 Jun 2014 10:51:12 -0400" and the
+    JSON API like "2014-06-02T10:51:12.000-0400", both in the time zone of
+    the Jira user.
+    """
+    try:
+        return datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%f%z')
+    except ValueError:
+        return parsedate_to_datetime(text)
+
+
+def sync_mark(items, margin=timedelta(minutes=5)):
+    """High-water mark for incremental sync of items, None if no dates.
+
+    This is the latest updated date of items less margin, formatted for JQL
+    in the time zone that Jira gave it in. Jira interprets dates in JQL in
+    the Jira user's time zone, which need not be the local one.
+    """
+    latest = None
+    for item in items:
+        text = item_updated(item)
+        if (text):
+            updated = parse_jira_datetime(text)
+            if (latest is None or updated > latest):
+                latest = updated
+    if (latest is None):
+        return None
+    return (latest - margin).strftime('%Y/%m/%d %H:%M')
+
+
+def sync_jira_items(session, query, fields, options, cache, state_path):
+    """Incrementally update local copy of query results, return list of items.
+
+    The first run does a full query. Later runs fetch only the issues
+    updated since the high-water mark recorded by the previous run, by
+    adding an `updated >= "<mark>"` clause to the query, and merge these
+    into the local issue set. A keys only query of the full JQL then gives
+    the current membership and order of the result set so that issues that
+    have been deleted, or have moved out of the result set, are dropped and
+    those that have come into it without being updated are fetched.
+    The mark is taken from the latest updated date of the issues, as given
+    by Jira, so that it doesn't depend on the local clock or time zone (see
+    sync_mark()), less a few minutes to allow for issues updated while the
+    query runs. Re-fetching a few issues twice is harmless.
+
+    If running offline then the local issue set is used as is.
+    """
+    (mark, items) = load_sync_state(state_path)
+    if (options.offline):
+        if (not os.path.exists(state_path)):
+            raise Exception("No incremental sync state in %s, cannot run offline" % (state_path))
+        return(list(items.values()))
+    if ('updated' not in fields):
+        fields = list(fields) + ['updated']
+    if (mark is None):
+        logging.warn("No incremental sync state, doing full query")
+        delta_query = query
+    else:
+        (jql_filter, order_by) = split_jql_order_by(query)
+        delta_query = '(%s) AND updated >= "%s" %s' % (jql_filter, mark, order_by)
+    num_updated = 0
+    for item in search_jira(session, delta_query, fields, options, cache):
+        # take a copy because query_jira() clears items after use
+        items[item_key(item)] = copy.deepcopy(item)
+        num_updated += 1
+    new_mark = sync_mark(items.values()) or mark
+    if (mark is not None):
+        keys = [item_key(item) for item in
+                search_jira(session, query, ['key'], options, cache)]
+        # Issues can come into the results without being updated, e.g. by
+        # JQL on sprints or relative dates, so fetch those not yet seen
+        missing = [key for key in keys if key not in items]
+        num_added = 0
+        for n in range(0, len(missing), LINKED_BATCH_SIZE):
+            for item in fetch_issues_by_key(session, missing[n:n + LINKED_BATCH_SIZE],
+                                            fields, options, cache):
+                items[item_key(item)] = item
+                num_added += 1
+        num_dropped = len(items)
+        items = OrderedDict((key, items[key]) for key in keys if key in items)
+        num_dropped -= len(items)
+        logging.warn("Incremental sync since %s: %d updated, %d added, %d dropped, %d total" %
+                     (mark, num_updated, num_added, num_dropped, len(items)))
+    save_sync_state(state_path, new_mark, items)
+    return(list(items.values()))
+
+
+def fetch_issues_by_key(session, keys, fields, options, cache):
+    """List of items for the issues with keys, of the types we report on.
+
+    Jira rejects the whole query with 400 Bad Request if any key doesn't
+    exist or can't be seen so on that error the keys are split in half and
+    each half tried again, down to single keys which are skipped with a
+    warning. Other errors are raised.
+    """
+    query = 'key in (%s) AND issuetype in (%s) ORDER BY key ASC' % (
+        ', '.join(keys), ', '.join('"%s"' % (t) for t in JIRA_ISSUE_TYPES))
+    try:
+        # take copies because query_jira() clears items after use
+        return([copy.deepcopy(item) for item in search_jira(session, query, fields, options, cache)])
+    except HTTPError as e:
+        if (e.code != 400):
+            raise
+        if (len(keys) == 1):
+            logging.warn("Cannot fetch linked issue %s: %s" % (keys[0], e))
+            return([])
+        half = len(keys) // 2
+        return(fetch_issues_by_key(session, keys[:half], fields, options, cache) +
+               fetch_issues_by_key(session, keys[half:], fields, options, cache))
+
+
+def fetch_linked_issues(session, results, fields, options, cache):
+    """Fetch issues that are linked to from results but not in them.
+
+    results is (features, policies, user_stories, epics) as from
+    split_jira_results(). The keys of all link and epic link targets not
+    in results are collected, without duplicates, and fetched in batches of
+    LINKED_BATCH_SIZE with up to options.threads queries at once. Only one
+    level of links is followed. Returns (features, policies, user_stories,
+    epics) for the linked issues, numbered after those in results. Linked
+    issues of unexpected type or with a bad priority are warned about and
+    left out rather than stopping the report.
+    """
+    known = set()
+    for issues in results:
+        known.update(issue.key for issue in issues)
+    keys = OrderedDict()
+    for issues in results:
+        for issue in issues:
+            for targets in (issue.issuelinks or {}).values():
+                for target in targets:
+                    if (target not in known):
+                        keys[target] = True
+            # Epic links are keys from the JSON backend, names from XML
+            epic = issue.epic
+            if (epic and epic not in known and re.match(r'[A-Z][A-Z0-9_]*-\d+$', epic)):
+                keys[epic] = True
+    keys = list(keys)
+    PROFILE.count('linked issues missing', len(keys))
+    if (not keys):
+        return([], [], [], [])
+    batches = [keys[n:n + LINKED_BATCH_SIZE] for n in range(0, len(keys), LINKED_BATCH_SIZE)]
+    logging.warn("Fetching %d linked issues not in query results in %d queries..." %
+                 (len(keys), len(batches)))
+    with ThreadPoolExecutor(max_workers=options.threads) as executor:
+        futures = [executor.submit(fetch_issues_by_key, session, batch, fields, options, cache)
+                   for batch in batches]
+        items = [item for future in futures for item in future.result()]
+    PROFILE.count('linked issues fetched', len(items))
+    return(split_jira_results(items, fields, sum(len(issues) for issues in results),
+                              options.epic_link_field, strict=False))
 
 
 relation_translations = {
@@ -182,6 +1458,7 @@ def parse_issue_links(key, el):
                 if (linktype not in links):
                     links[linktype] = []
                 links[linktype].append(issuekey.text)
+                PROFILE.count('links parsed')
         for inwardlink in issuelinktype.findall('./inwardlinks'):
             linktype = inwardlink.attrib['description']
             if (linktype in relation_translations):
@@ -193,13 +1470,15 @@ def parse_issue_links(key, el):
                 if (linktype not in links):
                     links[linktype] = []
                 links[linktype].append(issuekey.text)
+                PROFILE.count('links parsed')
     return(links)
 
 
 def parse_epic_link(key, el):
     """Extract key of epic this issue belongs to (if given), else ''.
 
-    Example XML:
+    el is the customfield element for the epic link, from the index made by
+    index_item(), or None. Example XML:
 
     <customfields>
       <customfield id="customfield_10730" key="com.pyxis.greenhopper.jira:gh-epic-link">
@@ -216,14 +1495,21 @@ def parse_epic_link(key, el):
     """
     if (el is None):
         return('')
-    for customfield in el.findall('./customfield'):
-        if (customfield.attrib['id'] == "customfield_10730"):
-            field = customfield.find('./customfieldvalues/customfieldvalue')
-            if (field.attrib['key'] == '$xmlutils.escape($text)'):
-                return field.text  # Use epic name if can't get key (Jira bug!)
-            else:
-                return field.attrib['key']
-    return('')
+    field = el.find('./customfieldvalues/customfieldvalue')
+    if (field is None):
+        return('')
+    if (field.attrib.get('key', '$xmlutils.escape($text)') == '$xmlutils.escape($text)'):
+        return field.text  # Use epic name if can't get key (Jira bug!)
+    else:
+        return field.attrib['key']
+
+
+def parse_customfield(key, el):
+    """Values of customfield element el joined with ', ', or None if no values."""
+    values = [v.text or '' for v in el.findall('./customfieldvalues/customfieldvalue')]
+    if (not values):
+        return(None)
+    return(', '.join(values))
 
 
 def parse_timeestimate(key, el):
@@ -271,221 +1557,582 @@ def parse_timeestimate_clause(clause):
         raise Exception("Failed to parse time estimate '%s'" % (clause))
 
 
-def split_jira_results(root, fields):
-    """Separate results into features, policies and user_stories."""
+def index_item(item):
+    """Index the children of item in one pass.
+
+    Returns (elements, customfields) where elements is a dict of tag to the
+    first child with that tag, as item.find(tag) would give, and
+    customfields is a dict of custom field id to customfield element.
+    """
+    # reversed so that the first of any repeated tag or id is kept
+    elements = {child.tag: child for child in reversed(item)}
+    el = elements.get('customfields')
+    if (el is None):
+        return(elements, {})
+    return(elements, {customfield.get('id'): customfield for customfield in reversed(el)})
+
+
+def set_text_field(args, key, field, el):
+    """Set field from the text of el, or a placeholder if the issue doesn't have it."""
+    if (el is None):
+        args[field] = sys.intern('FIXME - missing %s' % (field))
+    else:
+        args[field] = el.text
+
+
+def set_issuelinks_field(args, key, field, el):
+    """Set issuelinks, and a copy in parsed_links, from the links in el."""
+    args['issuelinks'] = parse_issue_links(key, el)
+    # add_story_epics() replaces lists in issuelinks, this keeps them all
+    args['parsed_links'] = dict(args['issuelinks'] or {})
+
+
+def set_timeestimate_field(args, key, field, el):
+    """Set days from time estimate in seconds, if there is one."""
+    if (el is None):
+        set_text_field(args, key, field, el)
+    else:
+        args['days'] = parse_timeestimate(key, el)
+
+
+def set_custom_field(args, key, field, el):
+    """Set custom field from its values, or a placeholder if the issue doesn't have it."""
+    if (el is None):
+        set_text_field(args, key, field, el)
+    else:
+        args[field] = parse_customfield(key, el)
+
+
+def set_epic_link_field(args, key, field, el):
+    """Set epic from the epic link custom field el."""
+    args['epic'] = parse_epic_link(key, el)
+
+
+# Handlers to set issue fields from item elements, by tag, default set_text_field()
+FIELD_HANDLERS = {
+    'issuelinks': set_issuelinks_field,
+    'timeestimate': set_timeestimate_field,
+}
+
+
+class Issue(object):
+    """One issue from the Jira results, with its fields as attributes.
+
+    An issue also behaves as the dict of field name to value used before,
+    so issue['priority'], 'days' in issue and str.format(**issue) work.
+    The few distinct type, priority and status values are interned, and
+    keytarget, keyref and epic_ref are derived when used rather than
+    stored. Fields that have no slot (e.g. custom fields used in a
+    template) are kept in extra.
+    """
+
+    __slots__ = tuple(sorted(XML_FIELDS | set(['num', 'epic', 'epic_name', 'days', 'parsed_links',
+                                               'related', 'timeestimate', 'extra'])))
+    DERIVED = ('keytarget', 'keyref', 'epic_ref')
+    INTERNED = frozenset(['type', 'priority', 'status'])
+    FIELDS = frozenset(__slots__) - set(['extra'])
+    GETTABLE = FIELDS | set(DERIVED)
+
+    def __init__(self, fields=None):
+        self.extra = None
+        for (name, value) in (fields or {}).items():
+            self[name] = value
+
+    @property
+    def keytarget(self):
+        return "\\hypertarget{%s}{}" % (self.key)
+
+    @property
+    def keyref(self):
+        return "\\hyperlink{%s}{%s}" % (self.key, self.key)
+
+    @property
+    def epic_ref(self):
+        return "\\hyperlink{%s}{%s}" % (self.epic_name, self.epic_name)
+
+    def __getitem__(self, name):
+        if (name in Issue.GETTABLE):
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                pass
+        elif (self.extra is not None and name in self.extra):
+            return self.extra[name]
+        raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        if (name in Issue.FIELDS):
+            if (name in Issue.INTERNED and value is not None):
+                value = sys.intern(value)
+            setattr(self, name, value)
+        elif (name in Issue.DERIVED):
+            raise KeyError("Cannot set derived field %s" % (name))
+        else:
+            if (self.extra is None):
+                self.extra = {}
+            self.extra[name] = value
+
+    def __contains__(self, name):
+        try:
+            self[name]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        names = [name for name in Issue.__slots__ if name != 'extra' and hasattr(self, name)]
+        names += [name for name in Issue.DERIVED if name in self]
+        if (self.extra):
+            names += list(self.extra)
+        return names
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return "Issue(%r)" % (dict((name, self[name]) for name in self.keys()))
+
+
+def split_jira_results(items, fields, num=0, epic_link_field=EPIC_LINK_FIELD, strict=True):
+    """Separate result items into features, policies and user_stories.
+
+    Takes an iterable of item elements such as from query_jira(), or of
+    issue dicts from query_jira_json() which are converted directly by
+    json_issue_to_issue(). Each is used only while it is being processed so
+    that they may be streamed. Issues are numbered from num + 1.
+
+    The children of each item are indexed in one pass, see index_item(),
+    and then each field is set by its handler from FIELD_HANDLERS. Custom
+    fields are set from the values of the customfield with that id, except
+    for epic_link_field which sets epic.
+
+    Summaries and descriptions are left as HTML, see convert_issues_html().
+
+    An issue of unexpected type or with a bad priority raises an exception,
+    or if strict is false is warned about and left out (as for linked issues
+    which are not in the query results, see fetch_linked_issues()).
+    """
     issues = ''
     features = []
     policies = []
     user_stories = []
     epics = []
-    num = 0
-    for item in root.findall('./channel/item'):
-        args = {}
-        # Try to find key first so we get useful debugging
-        key = 'UNKNOWN-KEY'
-        for field in (['key'] + fields + ['timeestimate', 'customfields']):
-            el = item.find(field)
-            if (field == 'issuelinks'):
-                args[field] = parse_issue_links(key, el)
-            elif (field == 'customfields'):
-                # Get epic link if present
-                args['epic'] = parse_epic_link(key, el)
-            elif (field == 'timeestimate' and el is not None):
-                # Get estimate in seconds
-                args['days'] = parse_timeestimate(key, el)
-            elif (el is None):
-                args[field] = 'FIXME - missing %s' % (field)
-            elif (el.text is None):
-                args[field] = None
-            else:
-                args[field] = el.text
-                if (field == 'key'):
-                    key = args['key']
-        num += 1
-        args['num'] = num
-        args['summary'] = html_to_tex(args['summary'])
-        if (args['description']):
-            args['description'] = html_to_tex(args['description'])
+    plan = OrderedDict()
+    custom_plan = OrderedDict()
+    for field in (['key'] + fields + ['timeestimate']):
+        if (field == epic_link_field):
+            continue
+        elif (field.startswith('customfield_')):
+            custom_plan[field] = set_custom_field
         else:
-            args['description'] = args['summary']
-        if (not re.search(r'[\?\!\.]$', args['description'])):
-            args['description'] += '.'
-        args['keytarget'] = "\\hypertarget{%s}{}" % (key)
-        args['keyref'] = "\\hyperlink{%s}{%s}" % (key, key)
+            plan[field] = FIELD_HANDLERS.get(field, set_text_field)
+    custom_plan[epic_link_field] = set_epic_link_field
+    plan = list(plan.items())
+    custom_plan = list(custom_plan.items())
+    for item in items:
+        if (isinstance(item, dict)):
+            # issue from the JSON API
+            args = json_issue_to_issue(item, fields, epic_link_field)
+            key = args['key']
+        else:
+            args = Issue()
+            (elements, customfields) = index_item(item)
+            # Find key first so we get useful debugging
+            el = elements.get('key')
+            key = el.text if (el is not None and el.text) else 'UNKNOWN-KEY'
+            for (field, handler) in plan:
+                handler(args, key, field, elements.get(field))
+            for (field, handler) in custom_plan:
+                handler(args, key, field, customfields.get(field))
+        PROFILE.count('issues parsed')
         # print(key+" --epic--> "+args['epic'])
         # What type is this?
+        error = None
         if (args['type'] == 'New Feature'):
             args['type'] = 'Feature'
-            summary = re.sub(r'Feature:\s+', '', args['summary'])
-            if (summary == args['summary']):
-                raise Exception("%s: is Feature but without summary prefix '%s'" % (key, args['summary']))
-            args['summary'] = summary
-            if (args['priority'] not in PRIORITIES):
-                raise Exception("%s: is Feature with bad priority %s" % (key, args['priority']))
-            if ('days' not in args):
-                logging.warn("%s: is %s priority Feature without effort estimate" % (key, args['priority']))
-            features.append(args)
+            issues = features
         elif (args['type'] == 'Policy Question'):
             args['type'] = 'Policy'
-            summary = re.sub(r'Policy:\s+', '', args['summary'])
-            if (summary == args['summary']):
-                raise Exception("%s: is Policy but without summary prefix '%s'" % (key, args['summary']))
-            args['summary'] = summary
-            if (args['priority'] not in PRIORITIES):
-                raise Exception("%s: is Policy with bad priority %s" % (key, args['priority']))
-            policies.append(args)
+            issues = policies
         elif (args['type'] == 'User Story'):
-            user_stories.append(args)
-            if (args['priority'] not in PRIORITIES):
-                raise Exception("%s: is User Story with bad priority %s" % (key, args['priority']))
+            issues = user_stories
         elif (args['type'] == 'Epic'):
-            epics.append(args)
+            issues = epics
         else:
-            raise Exception("%s: I unexpected type %s" % (key, args['type']))
+            error = "%s: I unexpected type %s" % (key, args['type'])
+        if (error is None and args['type'] != 'Epic' and args['priority'] not in PRIORITIES):
+            error = "%s: is %s with bad priority %s" % (key, args['type'], args['priority'])
+        if (error is not None):
+            if (strict):
+                raise Exception(error)
+            logging.warn("Ignoring linked issue %s" % (error))
+            continue
+        if (args['type'] == 'Feature' and 'days' not in args):
+            logging.warn("%s: is %s priority Feature without effort estimate" % (key, args['priority']))
+        num += 1
+        args['num'] = num
+        issues.append(args)
 
     return(features, policies, user_stories, epics)
 
 
+def convert_issues_html(issues, workers=1, chunk_size=64, linked=()):
+    """Convert the summary and description of each of issues from HTML to TeX.
+
+    Conversion is most of the CPU time in building the report so all the
+    HTML not in TEX_CACHE is converted in one batch, see
+    convert_html_batch(), and the results written back in order. Then the
+    description defaults to the summary and ends with a full stop, and the
+    'Feature:' or 'Policy:' prefix of feature and policy summaries is
+    removed.
+
+    A feature or policy without the prefix raises an exception unless its
+    key is in linked, the keys of issues from fetch_linked_issues(), in
+    which case it is warned about. Returns the set of keys of those linked
+    issues, which should be left out of the report.
+    """
+    bad = set()
+    htmls = []
+    for issue in issues:
+        htmls.append(issue.summary)
+        if (issue.description):
+            htmls.append(issue.description)
+    texs = iter(TEX_CACHE.get_many(htmls, lambda h: convert_html_batch(h, workers, chunk_size)))
+    for issue in issues:
+        issue.summary = next(texs)
+        if (issue.description):
+            issue.description = next(texs)
+        else:
+            issue.description = issue.summary
+        if (not re.search(r'[\?\!\.]$', issue.description)):
+            issue.description += '.'
+        if (issue.type in ('Feature', 'Policy')):
+            summary = re.sub(issue.type + r':\s+', '', issue.summary)
+            if (summary == issue.summary):
+                error = "%s: is %s but without summary prefix '%s'" % (issue.key, issue.type, issue.summary)
+                if (issue.key not in linked):
+                    raise Exception(error)
+                logging.warn("Ignoring linked issue %s" % (error))
+                bad.add(issue.key)
+            issue.summary = summary
+    return(bad)
+
+
+class EpicIndex(object):
+    """Epics indexed by both key and name for resolving epic links.
+
+    Because of the Jira bug noted in parse_epic_link() the epic link may be
+    either the epic key or the epic name. Names are matched against the
+    epic summary, which has been through html_to_tex(), so a name that
+    doesn't match as is is also tried after the same conversion, of the
+    name as given just as for the summary. If more than one epic has the
+    same name the first is used.
+    """
+
+    def __init__(self, epics):
+        self.by_key = {}
+        self.by_name = {}
+        self.tex_names = {}
+        for epic in epics:
+            self.by_key[epic.key] = epic
+            self.by_name.setdefault(epic.summary, epic)
+
+    def resolve(self, ref):
+        """Epic for ref which may be a key or a name, else None."""
+        epic = self.by_key.get(ref)
+        if (epic is None):
+            epic = self.by_name.get(ref)
+        if (epic is None and ref):
+            if (ref not in self.tex_names):
+                self.tex_names[ref] = html_to_tex(ref)
+            epic = self.by_name.get(self.tex_names[ref])
+        return(epic)
+
+
 def add_epic_names(issues, epics):
     """Add a field epic_name to each issue.
 
     If we can't get a name from the supposed key then just use the key
-    value as the name.
+    value as the name. Epic references that can't be resolved are reported
+    together at the end, and returned as a dict of reference to list of
+    issue keys.
     """
+    index = EpicIndex(epics)
+    unresolved = OrderedDict()
     for issue in issues:
         if ('epic' in issue):
-            epic_key = issue['epic']
-            for epic in epics:
-                if (epic['key'] == epic_key):
-                    issue['epic_name'] = epic['summary']
-                    issue['epic_ref'] = '\\hyperlink{%s}{%s}' % (
-                        issue['epic_name'], issue['epic_name'])
-                    break
-            if ('epic_name' not in issue):
-                logging.debug("%s: Failed to find epic name for %s (using this)" % (issue['key'], epic_key))
-                issue['epic_name'] = epic_key
-
-
-def add_story_epics(issues, user_stories_by_key):
+            epic_key = issue.epic
+            epic = index.resolve(epic_key)
+            if (epic is not None):
+                issue.epic_name = epic.summary
+            else:
+                unresolved.setdefault(epic_key, []).append(issue.key)
+                issue.epic_name = epic_key
+    if ('' in unresolved):
+        logging.warn("%d issues have no epic link: %s" %
+                     (len(unresolved['']), ', '.join(unresolved[''])))
+    refs = [ref for ref in unresolved if ref != '']
+    if (refs):
+        logging.warn("Failed to find epics for %d references (using reference as name): %s" % (
+            len(refs), '; '.join("%s (%s)" % (ref, ', '.join(unresolved[ref])) for ref in refs)))
+    return(unresolved)
+
+
+def add_story_epics(issues, registry):
     """Add a field story_epics to each issue in issues base on the epics its stories rely on."""
     linktype = 'Is relied upon by'
     for issue in issues:
         epic_names = set()
-        if (issue['issuelinks'] and linktype in issue['issuelinks']):
+        if (issue.issuelinks and linktype in issue.issuelinks):
             keep = []
-            for target in issue['issuelinks'][linktype]:
-                if (target in user_stories_by_key):
-                    story = user_stories_by_key[target]
-                    epic_names.add(story['epic_name'])
+            for target in issue.issuelinks[linktype]:
+                story = registry.find(target, ('User Story',))
+                if (story is not None):
+                    epic_names.add(story.epic_name)
                     keep.append(target)
                 else:
                     print("Non-story %s linked from %s, link ignored" %
-                          (target, issue['key']))
+                          (target, issue.key))
             # replace with the list of keepers
-            issue['issuelinks'][linktype] = keep
-        issue['issuelinks']['User story groups'] = list(epic_names)
+            issue.issuelinks[linktype] = keep
+        issue.issuelinks['User story groups'] = list(epic_names)
 
 
 def add_related(issues):
     """Add related field built from issuelink."""
     for issue in issues:
-        issue['related'] = ''
-        if (issue['issuelinks']):
-            for linktype in sorted(issue['issuelinks'].keys()):
+        issue.related = ''
+        if (issue.issuelinks):
+            for linktype in sorted(issue.issuelinks.keys()):
                 targets = []
-                for target in sorted(issue['issuelinks'][linktype], key=key_number):
+                for target in sorted(issue.issuelinks[linktype], key=key_number):
                     targets.append("\\hyperlink{%s}{%s}" % (target, target))
-                issue['related'] += '\n' + linktype + ': ' + ', '.join(targets) + '\n'
+                issue.related += '\n' + linktype + ': ' + ', '.join(targets) + '\n'
 
 
-def get_issue(issues, target, msg="issues"):
-    """Lookup issue based on the key.
+class IssueRegistry(object):
+    """All issues indexed by key, with views of the issues of each type.
 
-    FIXME - This is mindblowingly inefficient! need lookup by key
+    Built once after split_jira_results() so that all lookups of link
+    targets are by key rather than by scanning lists of issues.
     """
-    for t in (issues):
-        if (t['key'] == target):
-            return(t)
-    raise Exception("Cannot find %s in %s" % (target, msg))
 
-
-def infer_feature_policy_priorities(user_stories, other, fp, modify=True):
+    def __init__(self, features=(), policies=(), user_stories=(), epics=()):
+        self.by_key = {}
+        self.by_type = OrderedDict((t, []) for t in ISSUE_TYPES)
+        for issues in (features, policies, user_stories, epics):
+            for issue in issues:
+                self.add(issue)
+
+    def add(self, issue):
+        """Add issue to registry."""
+        self.by_key[issue.key] = issue
+        self.by_type.setdefault(issue.type, []).append(issue)
+
+    def __contains__(self, key):
+        return key in self.by_key
+
+    def __len__(self):
+        return len(self.by_key)
+
+    @property
+    def features(self):
+        return self.by_type['Feature']
+
+    @property
+    def policies(self):
+        return self.by_type['Policy']
+
+    @property
+    def user_stories(self):
+        return self.by_type['User Story']
+
+    @property
+    def epics(self):
+        return self.by_type['Epic']
+
+    def find(self, key, types=None):
+        """Issue with key, optionally only if of one of types, else None."""
+        issue = self.by_key.get(key)
+        if (issue is None or (types is not None and issue.type not in types)):
+            return(None)
+        PROFILE.count('links resolved')
+        return(issue)
+
+
+def priority_graph(registry, transitive=False):
+    """Build PriorityGraph of the features, policies and user stories in registry.
+
+    Links to issues outside the query results can't be followed and are
+    warned about, cycles of issues that rely on each other are printed as
+    inconsistencies but don't stop inference. Epics and issues with a
+    priority not in PRIORITY_TO_VALUE (e.g. Minor) are left out of the graph,
+    links to them are ignored.
+
+    By default only the 'Is relied upon by' links are used because
+    add_story_epics() has already dropped those from non-stories, the 'Relies
+    on' links from features would otherwise bring them back. If transitive is
+    set then the links are those parsed from Jira (parsed_links) in both
+    directions, so chains such as story -> feature -> policy are followed and
+    policies relied on by features take the priority of those features.
+    """
+    issues = []
+    for issue_type in ('Feature', 'Policy', 'User Story'):
+        for issue in registry.by_type[issue_type]:
+            if (issue.priority in PRIORITY_TO_VALUE):
+                issues.append(issue)
+            else:
+                logging.warn("Ignoring %s for priorities, unknown priority %s" %
+                             (issue.key, issue.priority))
+    if (transitive):
+        graph = PriorityGraph(issues, PRIORITY_TO_VALUE, links_field='parsed_links')
+    else:
+        graph = PriorityGraph(issues, PRIORITY_TO_VALUE, linktypes=('Is relied upon by',))
+    for (dependent, dependency) in graph.dangling:
+        missing = dependency if dependency not in graph.types else dependent
+        if (missing not in registry):
+            logging.warn("Ignoring %s relies on %s for priorities, %s not found" %
+                         (dependent, dependency, missing))
+    for cycle in graph.cycles():
+        print("INCONSISTENCY: cycle of issues that rely on each other: %s" %
+              (', '.join(sorted(cycle, key=key_number))))
+    PROFILE.count('priority graph edges', sum(len(d) for d in graph.dependencies.values()))
+    return(graph)
+
+
+def infer_feature_policy_priorities(inferred, fp, modify=True, links_field='issuelinks'):
     """Infer feature and policy priorities from user_story priorities.
 
     The inferred feature or policy priority will be the highest of the priorities
-    of the stories that rely upon it. For policies we also look through
-    the other issues which will be features and take the highest of these
-    priorities. This implies that feature priorities must be inferred
-    before policy priorities.
-
-
+    of the issues that rely upon it, after their own priorities have been
+    inferred. inferred is the dict of key to value from a single
+    graph.infer_max(('Feature', 'Policy'), modify) which follows chains of any
+    length (story -> feature -> policy ...), so the order in which lists of
+    issues are checked doesn't matter. links_field is the field the graph's
+    links were taken from, see priority_graph().
     """
     for issue in fp:
+        key = issue.key
         priority = None
-        if ('Is relied upon by' in issue['issuelinks']):
-            for target in issue['issuelinks']['Is relied upon by']:
-                t = get_issue(user_stories + other, target)
-                p = t['priority']
-                if (priority is None or PRIORITY_TO_VALUE[p] > PRIORITY_TO_VALUE[priority]):
-                    priority = p
-        else:
-            print("Issue %s is not relied upon by any issue" % (issue['key']))
+        if ('Is relied upon by' not in (issue.get(links_field) or {})):
+            print("Issue %s is not relied upon by any issue" % (key))
+        elif (key in inferred):
+            priority = VALUE_TO_PRIORITY[inferred[key]]
         if (priority is None):
-            print("No priority calculated for %s, treating as Low" %
-                  (issue['key']))
+            print("No priority calculated for %s, treating as Low" % (key))
             priority = 'Low'
-        elif (PRIORITY_TO_VALUE[issue['priority']] < PRIORITY_TO_VALUE[priority]):
+        elif (PRIORITY_TO_VALUE[issue.priority] < PRIORITY_TO_VALUE[priority]):
             print("INCONSISTENCY: %s has priority %s, which is lower from inferred priority %s" % (
-                issue['key'], issue['priority'], priority))
+                key, issue.priority, priority))
             if (modify):
                 print("%s priority changed %s -> %s" %
-                      (issue['key'], issue['priority'], priority))
-                issue['priority'] = priority
-        elif (PRIORITY_TO_VALUE[issue['priority']] > PRIORITY_TO_VALUE[priority]):
+                      (key, issue.priority, priority))
+                issue.priority = priority
+        elif (PRIORITY_TO_VALUE[issue.priority] > PRIORITY_TO_VALUE[priority]):
             print("%s has priority %s, which is higher than inferred priority %s" % (
-                issue['key'], issue['priority'], priority))
+                key, issue.priority, priority))
 
 
-def check_story_priorities(features, policies, user_stories, modify=False):
+def check_story_priorities(graph, user_stories, modify=False):
     """Infer story priorities from feature and policy priorities as a sanity check.
 
     The story priority calculated will be the lowest of the priorities of the
-    features and policies it relies upon. An inconsistency warning will be shown
-    if the actual story priority is higher than this, a simple note if it is
-    lower.
+    features and policies it relies upon, directly or through other issues. An
+    inconsistency warning will be shown if the actual story priority is higher
+    than this, a simple note if it is lower.
 
     If modify is true, then instead of showing a warning, the priority will be
     changed. This is a BACKWARDS process, it makes more sense
     to prioritize the user stories and then infer feature and policy
     priorities from that. See infer_feature_policy_priorities().
     """
+    lowest = graph.infer_min(('User Story',))
     for issue in user_stories:
+        key = issue.key
         priority = None
-        if ('Relies on' in issue['issuelinks']):
-            for target in issue['issuelinks']['Relies on']:
-                t = get_issue(features + policies, target)
-                p = t['priority']
-                if (p is None):
-                    raise Exception(
-                        "Cannot find %s in features or priorities" % (target))
-                if (priority is None or PRIORITY_TO_VALUE[p] < PRIORITY_TO_VALUE[priority]):
-                    priority = p
-        else:
-            print("Issue %s does not rely on any feature or policy" %
-                  (issue['key']))
+        if ('Relies on' not in (issue.get(graph.links_field) or {})):
+            print("Issue %s does not rely on any feature or policy" % (key))
+        elif (key in lowest):
+            priority = VALUE_TO_PRIORITY[lowest[key]]
         if (priority is None):
-            print("No priority calculated for %s, treating as Low" %
-                  (issue['key']))
+            print("No priority calculated for %s, treating as Low" % (key))
             priority = 'Low'
-        elif (PRIORITY_TO_VALUE[issue['priority']] > PRIORITY_TO_VALUE[priority]):
+        elif (PRIORITY_TO_VALUE[issue.priority] > PRIORITY_TO_VALUE[priority]):
             print("INCONSISTENCY: %s has priority %s, higher than inferred priority %s" % (
-                issue['key'], issue['priority'], priority))
+                key, issue.priority, priority))
             if (modify):
-                print("Setting %s to priority %s" % (issue['key'], priority))
-                issue['priority'] = priority
-        elif (PRIORITY_TO_VALUE[issue['priority']] < PRIORITY_TO_VALUE[priority]):
+                print("Setting %s to priority %s" % (key, priority))
+                issue.priority = priority
+        elif (PRIORITY_TO_VALUE[issue.priority] < PRIORITY_TO_VALUE[priority]):
             print("%s has priority %s, lower than inferred priority %s" %
-                  (issue['key'], issue['priority'], priority))
+                  (key, issue.priority, priority))
+
+
+def what_if_priorities(graph, changes):
+    """Show the effect of changing the priorities of some issues.
+
+    changes is a list of (key, priority). Only the issues that rely on, or are
+    relied upon by, those changed are re-inferred, see PriorityGraph.update().
+    The issues are updated so that the report is rendered as if the changes
+    had been made in Jira.
+    """
+    values = {}
+    for (key, priority) in changes:
+        if (key not in graph.types):
+            raise Exception("Cannot find %s for what if priority change" % (key))
+        values[key] = PRIORITY_TO_VALUE[priority]
+    for key in sorted(graph.update(values), key=key_number):
+        issue = graph.issues[key]
+        priority = VALUE_TO_PRIORITY[graph.effective[key]]
+        if (priority != issue.priority):
+            print("What if: %s priority changed %s -> %s" %
+                  (key, issue.priority, priority))
+            issue.priority = priority
+        if (issue.type == 'User Story' and key in graph.lowest):
+            print("What if: %s inferred priority is %s" %
+                  (key, VALUE_TO_PRIORITY[graph.lowest[key]]))
+
+
+def link_graph(registry):
+    """Build LinkGraph of all issues in registry, with the epics of user stories."""
+    index = EpicIndex(registry.epics)
+    epic_of = {}
+    for issue in registry.user_stories:
+        epic = index.resolve(issue.get('epic'))
+        if (epic is not None):
+            epic_of[issue.key] = epic.key
+    return(LinkGraph(registry.by_key.values(), epic_of))
+
+
+def show_planning_queries(registry, affected, shared):
+    """Print answers to planning queries over the links between issues.
+
+    affected is a list of issue keys for which to show all the user stories
+    that rely on them, directly or not. shared is a list of (epic, epic)
+    pairs, keys or names, for which to show the features relied on by user
+    stories in both.
+    """
+    graph = link_graph(registry)
+    index = EpicIndex(registry.epics)
+    for key in affected:
+        stories = graph.affected(key)
+        print("%d user stories rely on %s: %s" % (len(stories), key, ', '.join(stories)))
+    for (ref_a, ref_b) in shared:
+        epics = [index.resolve(ref) for ref in (ref_a, ref_b)]
+        if (None in epics):
+            raise Exception("Cannot find epics %s and %s" % (ref_a, ref_b))
+        features = graph.shared(epics[0]['key'], epics[1]['key'])
+        print("%d features shared by epics %s and %s: %s" % (
+            len(features), epics[0]['key'], epics[1]['key'], ', '.join(features)))
 
 
 def add_effort_estimates(features):
@@ -494,161 +2141,332 @@ def add_effort_estimates(features):
     totals = {}
     missing = {}
     for issue in features:
-        priority = issue['priority']
+        priority = issue.priority
         if (priority not in totals):
             num[priority] = 0
             totals[priority] = 0.0
             missing[priority] = []
         num[priority] += 1
         if ('days' in issue):
-            totals[priority] += issue['days']
+            totals[priority] += issue.days
         else:
-            missing[priority].append(issue['key'])
+            missing[priority].append(issue.key)
     for priority in sorted(totals.keys()):
         print("Effort estimate for %d %s features = %.1d work days" % (num[priority], priority, totals[priority]))
         if (len(missing[priority]) > 0):
             print("  (missing estimates for " + ','.join(missing[priority]) + ')')
 
 
-# Options
-#
-parser = OptionParser(
-    description="Make query to Jira and format results as text message to stdout")
-parser.add_option("-u", "--show-uri", dest="show_uri", action="store_true",
-                  help="show query URI and exit")
-parser.add_option("-s", "--show-xml", dest="show_xml", action="store_true",
-                  help="show XML response from Jira and exit")
-parser.add_option("-v", "--verbose", action="store_true",
-                  help="be verbose")
-(options, args) = parser.parse_args()
-
-# Config
-#
-# Look in current dirs, user home, script install
-config = RawConfigParser()
-for loc in os.curdir, os.path.expanduser("~"), os.path.dirname(__file__):
-    try:
-        with open(os.path.join(loc, 'irs_reporter.cfg')) as source:
-            config.readfp(source)
-        break  # one success is enough
-    except IOError:
-        pass
-#
-section = 'irs_reporter'
-name = config.get(section, 'name')
-username = config.get(section, 'username')
-password = config.get(section, 'password')
-baseuri = config.get(section, 'baseuri')
-# as cut-paste from advanced search box in Jira
-query = config.get(section, 'query')
-# See
-# https://confluence.atlassian.com/jira/displaying-search-results-in-xml-185729644.html
-# for a description of fields available
-fields = ['key', 'type', 'summary', 'description', 'status',
-          'link', 'component', 'priority', 'issuelinks', 'timetracking', 'allcustom']
-
-if (not query):
-    raise Exception("No query in config!")
-
-# Get data from Jira
-root = query_jira(baseuri, query, username, password, fields, options)
-(features, policies, user_stories, epics) = split_jira_results(root, fields)
-add_epic_names(user_stories, epics)
-user_stories_by_key = {}
-for issue in user_stories:
-    user_stories_by_key[issue['key']] = issue
-add_story_epics(features, user_stories_by_key)
-add_story_epics(policies, user_stories_by_key)
-add_related(features)
-add_related(policies)
-add_related(user_stories)
-
-# Adjust feature and policy priorities based on user story priorities
-print("\nChecking/inferring feature priorities")
-infer_feature_policy_priorities(user_stories, [], features)
-print("\nChecking/inferring policy priorities")
-infer_feature_policy_priorities(user_stories, features, policies)
-
-# Sanity check than inference the other way works...
-print("\nChecking story priorities")
-check_story_priorities(features, policies, user_stories)
-print("")
-
-print("\nAdding up effort estimates for each priority")
-add_effort_estimates(features)
-print("")
-
-script_dir = os.path.dirname(__file__)
-template_dir = os.path.join(script_dir, 'templates')
-template_prefix = 'irs_'
-
-# Use standard templates ala
-# http://docs.python.org/2/library/string.html#format-examples
-wrapper_template = open(os.path.join(template_dir, template_prefix + "wrapper.tpl")).read()
-
-# Now wrap issues
-wrapper_args = {'name': name,
-                'now': str(datetime.now()),
-                'date': str(date.today()),
-                'query': query,
-                'program': os.path.basename(__file__)}
-
-
-feature_template = """{keytarget}
-\subsubsection{{Feature: {summary} ({key}, {priority})}}
-
-{description}
-{related}
-
-"""
-features_txt = ''
-for priority in PRIORITIES:
-    features_txt += "\subsection{{%s priority features}}\n\n" % (priority)
-    for issue in sorted(features, key=issue_number):
-        if (issue['priority'] == priority):
-            features_txt += feature_template.format(**issue)
-
-policy_template = """{keytarget}
-\subsubsection{{Policy: {summary} ({key}, {priority})}}
-
-{description}
-{related}
-
-"""
-policies_txt = ''
-for priority in PRIORITIES:
-    policies_txt += "\subsection{{%s priority policies}}\n\n" % (priority)
-    for issue in sorted(policies, key=issue_number):
-        if (issue['priority'] == priority):
-            policies_txt += policy_template.format(**issue)
-
-
-user_stories_template = """{keytarget}
-\subsubsection{{User story: {description} ({key}, {epic_name}, {priority})}}
-
-{related}
-
-"""
-user_stories_txt = ''
-epic_names = set()
-for issue in user_stories:
-    epic_names.add(issue['epic_name'])
-for epic_name in sorted(epic_names):
-    user_stories_txt += "\\hypertarget{%s}{}\n\subsection{%s}\n\n" % (epic_name, epic_name)
-    for issue in sorted(user_stories, key=lambda i: ((4 - PRIORITY_TO_VALUE[i['priority']]) * 10000 + issue_number(i))):
-        if (issue['epic_name'] == epic_name):
-            if (issue['related'] == ''):
-                issue['related'] = "\\textit{No features or policies have been associated with this user story.}\n"
-            user_stories_txt += user_stories_template.format(**issue)
-
-
-txt = wrapper_template.format(features=features_txt,
-                              policies=policies_txt,
-                              user_stories=user_stories_txt,
-                              **wrapper_args)
-
-filename = template_prefix + 'report.tex'
-fh = open(filename, 'w')
-fh.write(txt)
-fh.close()
-print("Written %s, done." % (filename))
+def render_report(wrapper_template, wrapper_args, features, policies, user_stories):
+    """Render the features, policies and user stories into wrapper_template, return text."""
+    features_txt = ''
+    features = sorted(features, key=issue_number)
+    for priority in PRIORITIES:
+        features_txt += "\subsection{{%s priority features}}\n\n" % (priority)
+        for issue in features:
+            if (issue.priority == priority):
+                features_txt += FEATURE_TEMPLATE.format_map(issue)
+
+    policies_txt = ''
+    policies = sorted(policies, key=issue_number)
+    for priority in PRIORITIES:
+        policies_txt += "\subsection{{%s priority policies}}\n\n" % (priority)
+        for issue in policies:
+            if (issue.priority == priority):
+                policies_txt += POLICY_TEMPLATE.format_map(issue)
+
+    user_stories_txt = ''
+    epic_names = set()
+    for issue in user_stories:
+        epic_names.add(issue.epic_name)
+    user_stories = sorted(user_stories, key=lambda i: ((4 - PRIORITY_TO_VALUE[i.priority]) * 10000 + issue_number(i)))
+    for epic_name in sorted(epic_names):
+        user_stories_txt += "\\hypertarget{%s}{}\n\subsection{%s}\n\n" % (epic_name, epic_name)
+        for issue in user_stories:
+            if (issue.epic_name == epic_name):
+                if (issue.related == ''):
+                    issue.related = "\\textit{No features or policies have been associated with this user story.}\n"
+                user_stories_txt += USER_STORY_TEMPLATE.format_map(issue)
+
+    return wrapper_template.format(features=features_txt,
+                                   policies=policies_txt,
+                                   user_stories=user_stories_txt,
+                                   **wrapper_args)
+
+
+def main():
+    """Run report based on options and config."""
+    # Options
+    #
+    parser = OptionParser(
+        description="Make query to Jira and format results as text message to stdout")
+    parser.add_option("-u", "--show-uri", dest="show_uri", action="store_true",
+                      help="show query URI and exit")
+    parser.add_option("-s", "--show-xml", dest="show_xml", action="store_true",
+                      help="show XML response from Jira (issues from the JSON API with "
+                           "--backend json) and exit")
+    parser.add_option("--page-size", dest="page_size", type="int", default=1000,
+                      help="number of issues to request in each page of results (default %default)")
+    parser.add_option("--threads", dest="threads", type="int", default=4,
+                      help="number of pages of results to fetch concurrently (default %default)")
+    parser.add_option("--cache-dir", dest="cache_dir",
+                      help="directory for cached Jira responses and TeX conversions (default from config "
+                           "cache_dir else ~/.cache/jira-tools)")
+    parser.add_option("--cache-ttl", dest="cache_ttl", type="int", default=0,
+                      help="reuse cached Jira responses younger than this many seconds (default %default)")
+    parser.add_option("--no-cache", dest="no_cache", action="store_true",
+                      help="don't read or write cached Jira responses")
+    parser.add_option("--offline", action="store_true",
+                      help="replay cached Jira responses without using the network")
+    parser.add_option("--incremental", action="store_true",
+                      help="fetch only issues updated since the last run and merge into "
+                           "the local issue set")
+    parser.add_option("--state-file", dest="state_file",
+                      help="local issue set for --incremental (default in cache dir)")
+    parser.add_option("--html-workers", dest="html_workers", type="int",
+                      default=os.cpu_count() or 1,
+                      help="number of processes (threads with free-threaded Python) to "
+                           "convert HTML to TeX with (default %default)")
+    parser.add_option("--html-chunk-size", dest="html_chunk_size", type="int", default=64,
+                      help="number of HTML strings given to each worker at a time (default %default)")
+    parser.add_option("--no-linked", dest="no_linked", action="store_true",
+                      help="don't fetch issues that are linked to but not in the query results")
+    parser.add_option("--cookie-file", dest="cookie_file",
+                      help="file to keep Jira login cookie in between runs (default in cache dir)")
+    parser.add_option("--backend", choices=['xml', 'json'],
+                      help="use the XML issue view or the JSON REST API to search Jira "
+                           "(default from config backend else xml)")
+    parser.add_option("--what-if", dest="what_if", action="append", default=[],
+                      metavar="KEY=PRIORITY",
+                      help="show the effect of changing the priority of issue KEY, "
+                           "may be repeated, the report is written to irs_whatif.tex "
+                           "instead of irs_report.tex")
+    parser.add_option("--transitive-priorities", dest="transitive_priorities", action="store_true",
+                      help="infer priorities over chains of links, so that policies relied "
+                           "on by features take the priority of those features")
+    parser.add_option("--affected", action="append", default=[], metavar="KEY",
+                      help="show the user stories that rely on issue KEY, directly "
+                           "or through other issues, may be repeated")
+    parser.add_option("--shared-features", dest="shared_features", action="append",
+                      default=[], metavar="EPIC,EPIC",
+                      help="show the features relied on by user stories in both "
+                           "epics (keys or names), may be repeated")
+    parser.add_option("--profile", metavar="FILE",
+                      help="write JSON summary of time and memory for each stage, "
+                           "and counters, to FILE")
+    parser.add_option("--cprofile", metavar="FILE",
+                      help="write cProfile stats for the run to FILE")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="be verbose")
+    (options, args) = parser.parse_args()
+    what_if = []
+    for change in options.what_if:
+        (key, sep, priority) = change.partition('=')
+        if (not sep or priority not in PRIORITY_TO_VALUE):
+            parser.error("Bad --what-if %s, expected KEY=PRIORITY with PRIORITY one of %s" %
+                         (change, ', '.join(PRIORITIES)))
+        what_if.append((key, priority))
+    shared = []
+    for pair in options.shared_features:
+        epics = pair.split(',')
+        if (len(epics) != 2):
+            parser.error("Bad --shared-features %s, expected EPIC,EPIC" % (pair))
+        shared.append(tuple(epics))
+
+    if (options.profile):
+        PROFILE.enabled = True
+        tracemalloc.start()
+    if (options.cprofile):
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+
+    # Config
+    #
+    # Look in current dirs, user home, script install
+    config = RawConfigParser()
+    for loc in os.curdir, os.path.expanduser("~"), os.path.dirname(__file__):
+        try:
+            with open(os.path.join(loc, 'irs_reporter.cfg')) as source:
+                config.read_file(source)
+            break  # one success is enough
+        except IOError:
+            pass
+    #
+    section = 'irs_reporter'
+    name = config.get(section, 'name')
+    username = config.get(section, 'username')
+    password = config.get(section, 'password')
+    baseuri = config.get(section, 'baseuri')
+    # as cut-paste from advanced search box in Jira
+    query = config.get(section, 'query')
+
+    script_dir = os.path.dirname(__file__)
+    template_dir = os.path.join(script_dir, 'templates')
+    template_prefix = 'irs_'
+
+    # Use standard templates ala
+    # http://docs.python.org/2/library/string.html#format-examples
+    wrapper_template = open(os.path.join(template_dir, template_prefix + "wrapper.tpl")).read()
+    issue_template = open(os.path.join(template_dir, template_prefix + "issue.tpl")).read()
+
+    # Custom field id of the epic link varies between Jira instances
+    options.epic_link_field = EPIC_LINK_FIELD
+    if (config.has_option(section, 'epic_link_field')):
+        options.epic_link_field = config.get(section, 'epic_link_field')
+
+    # Request only the fields the templates need
+    fields = report_fields([FEATURE_TEMPLATE, POLICY_TEMPLATE, USER_STORY_TEMPLATE, issue_template],
+                           options.epic_link_field)
+    if (options.verbose):
+        print("Requesting fields: " + ', '.join(fields))
+
+    if (not query):
+        raise Exception("No query in config!")
+    if (not options.backend):
+        options.backend = 'xml'
+        if (config.has_option(section, 'backend')):
+            options.backend = config.get(section, 'backend')
+
+    cache_dir = options.cache_dir
+    if (not cache_dir and config.has_option(section, 'cache_dir')):
+        cache_dir = config.get(section, 'cache_dir')
+    if (not cache_dir):
+        cache_dir = os.path.join(os.path.expanduser("~"), '.cache', 'jira-tools')
+    cache = None
+    if (options.offline and options.no_cache and not options.incremental):
+        raise Exception("Cannot use --offline with --no-cache!")
+    elif (not options.no_cache):
+        cache = ResponseCache(cache_dir, options.cache_ttl, options.offline)
+        os.makedirs(cache_dir, exist_ok=True)
+        TEX_CACHE.load(os.path.join(cache_dir, 'tex-cache.sqlite'))
+
+    # Get data from Jira
+    cookie_file = options.cookie_file
+    if (not cookie_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        cookie_file = os.path.join(cache_dir, 'session.json')
+    session = JiraSession(baseuri, username, password, cookie_file)
+    if (options.incremental):
+        state_file = options.state_file
+        if (not state_file):
+            os.makedirs(cache_dir, exist_ok=True)
+            state_key = json.dumps([baseuri, query, fields])
+            state_file = os.path.join(cache_dir, 'sync-' + hashlib.sha256(state_key.encode('utf-8')).hexdigest() +
+                                      '.' + options.backend)
+        items = sync_jira_items(session, query, fields, options, cache, state_file)
+    else:
+        items = search_jira(session, query, fields, options, cache)
+    with PROFILE.stage('query and split results'):
+        items = PROFILE.iterate('fetch and parse', items)
+        (features, policies, user_stories, epics) = split_jira_results(items, fields, 0, options.epic_link_field)
+    linked_keys = set()
+    if (options.offline and cache is None and not options.no_linked):
+        # --offline --no-cache --incremental, only the sync state can be used
+        logging.warn("Not fetching linked issues, no response cache to run offline from")
+    elif (not options.no_linked):
+        with PROFILE.stage('linked issues'):
+            linked = fetch_linked_issues(session, (features, policies, user_stories, epics),
+                                         fields, options, cache)
+            for (issues, more) in zip((features, policies, user_stories, epics), linked):
+                issues.extend(more)
+            linked_keys.update(issue.key for more in linked for issue in more)
+    session.close()
+    with PROFILE.stage('html_to_tex'):
+        bad = convert_issues_html(features + policies + user_stories + epics,
+                                  options.html_workers, options.html_chunk_size, linked_keys)
+        if (bad):
+            features[:] = [issue for issue in features if issue.key not in bad]
+            policies[:] = [issue for issue in policies if issue.key not in bad]
+    with PROFILE.stage('epics and links'):
+        registry = IssueRegistry(features, policies, user_stories, epics)
+        add_epic_names(user_stories, epics)
+        add_story_epics(features, registry)
+        add_story_epics(policies, registry)
+        add_related(features)
+        add_related(policies)
+        add_related(user_stories)
+
+    for key in options.affected:
+        if (key not in registry):
+            parser.error("Unknown issue %s for --affected, it is not in the query results "
+                         "or linked from them" % (key))
+    for (key, priority) in what_if:
+        issue = registry.by_key.get(key)
+        if (issue is None):
+            parser.error("Unknown issue %s for --what-if, it is not in the query results "
+                         "or linked from them" % (key))
+        elif (issue.type not in ('Feature', 'Policy', 'User Story') or
+                issue.priority not in PRIORITY_TO_VALUE):
+            parser.error("Issue %s for --what-if is a %s with priority %s, only features, "
+                         "policies and user stories with priority one of %s are used for "
+                         "priorities" % (key, issue.type, issue.priority, ', '.join(PRIORITIES)))
+    index = EpicIndex(registry.epics) if (shared) else None
+    for pair in shared:
+        for ref in pair:
+            if (index.resolve(ref) is None):
+                parser.error("Unknown epic %s for --shared-features, it is not the key or name "
+                             "of an epic in the query results or linked from them" % (ref))
+    if (options.affected or shared):
+        with PROFILE.stage('planning queries'):
+            print("\nPlanning queries")
+            show_planning_queries(registry, options.affected, shared)
+            print("")
+
+    with PROFILE.stage('priorities'):
+        # Adjust feature and policy priorities based on user story priorities
+        graph = priority_graph(registry, options.transitive_priorities)
+        (inferred, effective) = graph.infer_max(('Feature', 'Policy'))
+        print("\nChecking/inferring feature priorities")
+        infer_feature_policy_priorities(inferred, features, links_field=graph.links_field)
+        print("\nChecking/inferring policy priorities")
+        infer_feature_policy_priorities(inferred, policies, links_field=graph.links_field)
+
+        # Sanity check than inference the other way works...
+        print("\nChecking story priorities")
+        check_story_priorities(graph, user_stories)
+        print("")
+
+    if (what_if):
+        with PROFILE.stage('what if'):
+            print("\nWhat if priorities are changed: %s" % (', '.join(options.what_if)))
+            what_if_priorities(graph, what_if)
+            print("")
+
+    print("\nAdding up effort estimates for each priority")
+    add_effort_estimates(features)
+    print("")
+
+    # Now wrap issues
+    wrapper_args = {'name': name,
+                    'now': str(datetime.now()),
+                    'date': str(date.today()),
+                    'query': query,
+                    'program': os.path.basename(__file__)}
+
+    with PROFILE.stage('render'):
+        txt = render_report(wrapper_template, wrapper_args, features, policies, user_stories)
+
+    # Don't overwrite the real report with a what if one
+    filename = template_prefix + ('whatif.tex' if what_if else 'report.tex')
+    fh = open(filename, 'w')
+    fh.write(txt)
+    fh.close()
+    print("Written %s, done." % (filename))
+    TEX_CACHE.save()
+    print(TEX_CACHE.summary())
+    PROFILE.count('TeX cache memory hits', TEX_CACHE.hits)
+    PROFILE.count('TeX cache disk hits', TEX_CACHE.disk_hits)
+    PROFILE.count('TeX cache misses', TEX_CACHE.misses)
+
+    if (options.cprofile):
+        cprofiler.disable()
+        cprofiler.dump_stats(options.cprofile)
+        print("Written cProfile stats to %s" % (options.cprofile))
+    if (options.profile):
+        with open(options.profile, 'w') as fh:
+            json.dump(PROFILE.summary(), fh, indent=2)
+        print("Written profile to %s" % (options.profile))
+
+
+if __name__ == "__main__":
+    main()